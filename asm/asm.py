@@ -13,9 +13,21 @@
 #  DB 0x0a   ; a hex byte
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
+#
+#  .include "common.asm"   ; pull in another source file
+#
+#  .macro CALLL label, reg ; a macro with two parameters
+#  LDI reg,label
+#  CALL reg
+#  .endm
+#  CALLL PrintStr, R2
+#
+#  .link "lib/string.asm"  ; link in a library's assembled code here
 
+import os
 import sys
 import re
+import struct
 
 # Opcodes
 OPCODES = {
@@ -59,16 +71,99 @@ OPCODES = {
 # Capturing groups: label, opcode, operandA, operandB
 REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
 
+# Binary image format, must match the loader in ls8/cpu.py:
+# header (magic, version, load address, entry point, reserved,
+# program length, symbol count), program bytes, then the symbols
+# as (address, name length, name)
+IMAGE_MAGIC = b"LS8I"
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct("<4sBBBxHH")
+IMAGE_EXTENSION = ".ls8b"
+
+# Library object format: header (magic, version, reserved, code length,
+# symbol count, fixup count), code bytes, then the symbols and the
+# fixups, each as (offset, name length, name). Offsets are 2 bytes,
+# counted from the start of the code. Fixups are left unresolved, so
+# linking an object is copying its code and moving the offsets.
+OBJECT_MAGIC = b"LS8O"
+OBJECT_VERSION = 1
+OBJECT_HEADER = struct.Struct("<4sBxHHH")
+OBJECT_ENTRY = struct.Struct("<HB")
+OBJECT_EXTENSION = ".ls8o"
+
 # Regex for capturing DS and DB data
 REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
 REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
 
+# Compiled once, not per line
+PATTERN = re.compile(REGEX)
+PATTERN_DS = re.compile(REGEX_DS, re.IGNORECASE)
+PATTERN_DB = re.compile(REGEX_DB, re.IGNORECASE)
+
+# Directives (.include, .macro, .endm, .link) and their argument
+PATTERN_DIRECTIVE = re.compile(r"\.(\w+)\s*(.*)")
+
+# A line that may be a macro call: label, name, arguments
+PATTERN_CALL = re.compile(r"(?:(\w+?):)?\s*(\w+)(?:\s+(.*))?$")
+
+# How deeply includes and macros may nest, to catch ones that recurse
+MAX_DEPTH = 64
+
+# Programs have to fit in the LS-8's memory
+MEMORY_SIZE = 256
+
+# Objects already linked in this process, by path: (mtime, object)
+OBJECTS = {}
+
+# Opcode types and machine code as numbers, for emitting bytes directly
+OPCODE_BYTES = {
+    name: (info["type"], int(info["code"], 2)) for name, info in OPCODES.items()
+}
+
+# Register operands
+REGISTERS = {f"R{i}": i for i in range(8)}
+
+# Opcode names by machine code, for the optimizer
+OPCODE_NAMES = {code: name for name, (op_type, code) in OPCODE_BYTES.items()}
+
+# The optimizer tracks and removes stores to R0-R4 only. R5 and R6 are
+# the interrupt mask and status, which the CPU reads (and changes) on its
+# own, and R7 is the stack pointer.
+GENERAL_REGISTERS = range(5)
+
+# Instructions that end a basic block: control goes elsewhere, or into
+# code that may read any register
+BLOCK_ENDS = {"CALL", "RET", "INT", "IRET", "HLT", "JMP",
+              "JEQ", "JNE", "JGT", "JLT", "JLE", "JGE"}
+
+# ALU results the optimizer can work out when both inputs are constants
+FOLDS = {
+    "ADD": lambda a, b: a + b,
+    "SUB": lambda a, b: a - b,
+    "MUL": lambda a, b: a * b,
+    "AND": lambda a, b: a & b,
+    "OR":  lambda a, b: a | b,
+    "XOR": lambda a, b: a ^ b,
+    "SHL": lambda a, b: a << b,
+    "SHR": lambda a, b: a >> b,
+    "INC": lambda a, b: a + 1,
+    "DEC": lambda a, b: a - 1,
+    "NOT": lambda a, b: ~a,
+}
+
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-O] [inputfile] [outputfile]
+
+    An output file ending in .ls8b gets a binary image instead of text,
+    and one ending in .ls8o a library object to link into programs. -O runs
+    the peephole optimizer.
     """
 
+    optimize = "-O" in argv
+    argv = [arg for arg in argv if arg != "-O"]
+
     if len(argv) == 1:
         inputfile = "-"
         outputfile = "-"
@@ -82,10 +177,10 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-O] [infile.asm] [outfile.ls8]", file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    return inputfile, outputfile, optimize
 
 
 def open_files(inputfile, outputfile):
@@ -101,154 +196,292 @@ def open_files(inputfile, outputfile):
 
     if outputfile == "-":
         outputfile = sys.stdout
+    elif outputfile.endswith((IMAGE_EXTENSION, OBJECT_EXTENSION)):
+        outputfile = open(outputfile, "wb")
     else:
         outputfile = open(outputfile, "w")
 
     return inputfile, outputfile
 
 
-def normalize_line(groups):
-    """
-    Takes match groups and uppercases them if they're not None.
-    """
+# Every byte as text output writes it
+BINARY = ["{:08b}".format(v) for v in range(256)]
 
-    result = []
 
-    for g in groups:
-        if g is None:
-            result.append(None)
-        else:
-            result.append(g.upper())
+def p8(v):
+    return BINARY[v]
 
-    return result
 
+def is_word(text):
+    """True if text is one or more \\w characters (ASCII only)"""
+    return text.isascii() and text.replace('_', 'a').isalnum()
 
-def p8(v):
-    return "{:08b}".format(v)
 
+def split_line(line):
+    """
+    Split a stripped source line into label, opcode and operands with
+    string methods, the way PATTERN would. Returns None for anything but
+    the plain [label:] OPCODE [a[,b]] form, which PATTERN handles.
+    """
 
-def pass1(inputfile, sym, code):
+    label = None
+
+    colon = line.find(':')
+    if colon != -1:
+        label = line[:colon]
+        line = line[colon + 1:].lstrip()
+        if not is_word(label):
+            return None
+        if not line:
+            return label, None, None, None
+
+    words = line.split(None, 1)
+    opcode = words[0]
+    if not is_word(opcode):
+        return None
+    if len(words) == 1:
+        return label, opcode, None, None
+
+    op_a, comma, op_b = words[1].partition(',')
+    op_a = op_a.rstrip()
+    if not is_word(op_a):
+        return None
+    if not comma:
+        return label, opcode, op_a, None
+
+    op_b = op_b.strip()
+    if not is_word(op_b):
+        return None
+    return label, opcode, op_a, op_b
+
+
+def preprocess(inputfile, path=None):
     """
-    Pass 1
+    Expand .include directives and macros. Yields (path, line number,
+    text) for every source line, for pass1. Lines from a macro carry the
+    line number of the call.
 
-    * Read the source code lines
-    * Parse labels, opcodes, and operands
-    * Record label offsets
-    * Emit machine code
+    .include and .link paths are relative to the file they appear in. In a
+    macro body the parameter names are replaced by the arguments of each
+    call, and \\@ by a number unique to the call, for labels:
+
+        .macro WAIT reg
+        wait\\@: DEC reg
+        .endm
     """
 
-    # Source line number
-    line_num = 0
+    # Name -> (parameters, body lines)
+    macros = {}
 
-    # Current code address (for labels)
-    addr = 0
+    # Macro calls so far, for \@
+    expansions = 0
 
-    def get_reg(op, fatal=True):
-        """Get a register number from a string, e.g. "R2" -> 2"""
+    def fail(path, number, message):
+        print(f"{path or '<stdin>'}:{number}: {message}", file=sys.stderr)
+        sys.exit(2)
 
-        nonlocal line_num
+    def argument(text):
+        """A path argument, quoted or not"""
+        return text.strip().strip('"')
 
-        m = re.match(r"R([0-7])", op)
+    def expand(lines, path, depth):
+        """Expand (line number, text) pairs from path"""
 
-        if m is None:
-            if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
-            else:
-                return None
+        nonlocal expansions
 
-        return int(m.group(1))
+        base = os.path.dirname(path) if path else ""
+        lines = iter(lines)
 
-    def out0(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with zero operands"""
+        for number, line in lines:
+            if depth > MAX_DEPTH:
+                fail(path, number, "includes or macros nested too deeply")
 
-        nonlocal addr
+            # Comments never hold directives
+            text = line.split(';', 1)[0].strip()
 
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
+            if text[:1] == '.':
+                directive, arg = PATTERN_DIRECTIVE.match(text).groups()
+                directive = directive.upper()
 
-    def out1(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with one operand"""
+                if directive == "INCLUDE":
+                    name = os.path.join(base, argument(arg))
+                    try:
+                        f = open(name)
+                    except OSError:
+                        fail(path, number, f"can't include {name}")
+                    with f:
+                        yield from expand(enumerate(f, 1), name, depth + 1)
 
-        nonlocal addr
+                elif directive == "MACRO":
+                    params = arg.replace(',', ' ').upper().split()
+                    if not params:
+                        fail(path, number, "missing name for .macro")
 
-        reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
+                    body = []
+                    for _, line in lines:
+                        text = line.split(';', 1)[0].strip()
+                        if text.upper() == ".ENDM":
+                            break
+                        body.append(text)
+                    else:
+                        fail(path, number, f"missing .endm for macro {params[0]}")
 
-    def out2(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with two operands"""
+                    macros[params[0]] = (params[1:], body)
 
-        nonlocal addr
+                elif directive == "LINK":
+                    # pass1 does the linking, from wherever we are
+                    yield path, number, f".LINK {os.path.join(base, argument(arg))}"
 
-        reg_a = get_reg(op_a)
-        reg_b = get_reg(op_b)
+                else:
+                    # pass1 reports it
+                    yield path, number, text
+                continue
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
+            # Nothing to expand until a macro is defined
+            m = PATTERN_CALL.match(text) if macros else None
+            if m is None or m.group(2).upper() not in macros:
+                yield path, number, line
+                continue
 
-        addr += 3
+            label, name, args = m.groups()
+            params, body = macros[name.upper()]
+            args = [a.strip() for a in args.split(',')] if args else []
 
-    def out8(opcode, op_a, op_b, machine_code):
-        """Handle LDI opcode (type 8)"""
+            if len(args) != len(params):
+                fail(path, number,
+                     f"macro {name} takes {len(params)} arguments, got {len(args)}")
 
-        nonlocal addr
+            expansions += 1
 
-        reg_a = get_reg(op_a)
+            if label is not None:
+                yield path, number, f"{label}:"
 
-        try:
-            val_b = int(op_b, 0)
-            out_b = p8(val_b)
+            # Whole words only, so R1 doesn't match inside R10
+            values = dict(zip(params, args))
+            if values:
+                pattern = re.compile(r"\b(" + "|".join(params) + r")\b", re.IGNORECASE)
+                body = [pattern.sub(lambda m: values[m.group(1).upper()], b) for b in body]
+            body = [b.replace("\\@", str(expansions)) for b in body]
 
-        except ValueError:
-            # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+            # Macros can call macros
+            yield from expand([(number, b) for b in body], path, depth + 1)
+
+    return expand(enumerate(inputfile, 1), path, 0)
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
 
-        addr += 3
+def pass1(lines, sym, program, fixups, listing=None, starts=None, refs=None):
+    """
+    Pass 1
+
+    * Read the source code lines, as (path, line number, text) from
+      preprocess()
+    * Parse labels, opcodes, and operands
+    * Record label offsets
+    * Emit machine code into program, a bytearray
+    * Record a fixup for every symbol used as an operand, since it may not
+      be defined yet
+    * If listing is a list, annotate the code in it for the text output
+    * If starts is a list, record where each instruction starts in it (the
+      optimizer needs to tell code from data)
+    * If refs is a dict, record where each symbol is first used in it, for
+      pass2's errors
+    """
+
+    # File and line number of the current line, for errors
+    path = line_num = None
+
+    def where():
+        return f"{path or '<stdin>'}:{line_num}"
+
+    # Only build annotations when someone wants them
+    annotate = listing is not None
+
+    def get_reg(op):
+        """Get a register number from a string, e.g. "R2" -> 2"""
+
+        reg = REGISTERS.get(op)
+
+        if reg is None:
+            print(f"{where()}: unknown register {op}", file=sys.stderr)
+            sys.exit(1)
+
+        return reg
+
+    def handle_link(line):
+        """
+        Handle .link: copy a library's code in here, and move its symbols
+        and fixups along with it
+        """
+
+        m = PATTERN_DIRECTIVE.match(line)
+
+        if m is None or m.group(1).upper() != "LINK":
+            print(f"{where()}: unknown directive {line}", file=sys.stderr)
+            sys.exit(2)
+
+        code, lib_sym, lib_fixups = load_object(m.group(2).strip())
+        base = len(program)
+
+        for s, offset in sorted(lib_sym.items(), key=lambda item: item[1]):
+            if s in sym:
+                print(f"{where()}: {s} is already defined", file=sys.stderr)
+                sys.exit(2)
+
+            sym[s] = base + offset
+            if annotate:
+                listing.append((base + offset, f'# {s} (address {base + offset}):'))
+
+        program.extend(code)
+        fixups.extend((base + offset, s) for offset, s in lib_fixups)
+
+        if refs is not None:
+            for offset, s in lib_fixups:
+                refs.setdefault(s, where())
+
+    def check_ops(opcode, op_type, op_a, op_b):
+        """Check the operand count for sanity with a particular opcode"""
+
+        # LDI r,i or LDI r,label has two operands
+        desired = 2 if op_type == 8 else op_type
+        found = (op_a is not None) + (op_b is not None)
+
+        if found < desired:
+            print(f"{where()}: missing operand to {opcode}",
+                  file=sys.stderr)
+            sys.exit(1)
+        elif found > desired:
+            print(f"{where()}: unexpected operand to {opcode}",
+                  file=sys.stderr)
+            sys.exit(1)
 
     def handle_ds(line):
         """
         Handle DS pseudo-opcode
         """
 
-        nonlocal addr
-
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+        m = PATTERN_DS.match(line)
 
         if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
+            print(f"{where()}: missing argument to DS", file=sys.stderr)
             sys.exit(2)
 
         data = m.group(2)
 
-        for i in range(len(data)):
-            print_char = data[i]
-
-            if print_char == ' ':
-                print_char = '[space]'
+        if annotate:
+            for i, c in enumerate(data):
+                listing.append((len(program) + i, '[space]' if c == ' ' else c))
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
-
-        addr += len(data)
+        program.extend(ord(c) & 0xff for c in data)
 
     def handle_db(line):
         """
         Handle the DB pseudo-opcode
         """
 
-        nonlocal addr
-
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+        m = PATTERN_DB.match(line)
 
         if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
+            print(f"{where()}: missing argument to DB", file=sys.stderr)
             sys.exit(2)
 
         data = m.group(2)
@@ -257,146 +490,553 @@ def pass1(inputfile, sym, code):
             val = int(data, 0)
 
         except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
+            print(f"{where()}: invalid integer argument to DB",
                   file=sys.stderr)
             sys.exit(2)
 
+        if annotate:
+            listing.append((len(program), data))
+
         # Force to byte size
-        val &= 0xff
+        program.append(val & 0xff)
 
-        code.append(f"{p8(val)} # {data}")
+    for path, line_num, line in lines:
+        # Strip comments
+        comment_index = line.find(';')
+        if comment_index != -1:
+            line = line[:comment_index]
+
+        # Normalize
+        line = line.strip()
+
+        # Ignore blank lines
+        if line == '':
+            continue
+
+        # Directives still here after preprocessing
+        if line[0] == '.':
+            handle_link(line)
+            continue
+
+        # Plain instruction lines don't need the regex
+        groups = split_line(line)
+
+        if groups is None:
+            m = PATTERN.match(line)
+
+            if m is None:
+                print(f"{where()}: no match: {line}", file=sys.stderr)
+                sys.exit(3)
 
-        addr += 1
+            groups = m.groups()
 
-    def check_ops(opcode, op_a, op_b):
-        """Check operands for sanity with a particular opcode"""
+        label, opcode, op_a, op_b = groups
 
-        def check_ops_count(desired, found):
-            # Makes sure we have right operand count
-            if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
-            elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+        # Track label address
+        if label is not None:
+            label = label.upper()
+
+            # Including one defined by a library linked in earlier
+            if label in sym:
+                print(f"{where()}: {label} is already defined", file=sys.stderr)
+                sys.exit(2)
+
+            sym[label] = len(program)
+            if annotate:
+                listing.append((len(program), f'# {label} (address {len(program)}):'))
+
+        if opcode is None:
+            continue
+
+        opcode = opcode.upper()
+
+        if opcode == 'DS':
+            handle_ds(line)
+            continue
+        if opcode == 'DB':
+            handle_db(line)
+            continue
 
         # Make sure we know this opcode at all
-        if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
+        op_info = OPCODE_BYTES.get(opcode)
+        if op_info is None:
+            print(f"{where()}: unknown opcode {opcode}", file=sys.stderr)
             sys.exit(2)
 
-        op_type = OPCODES[opcode]["type"]
-
-        total_operands = 0
+        op_type, machine_code = op_info
 
         if op_a is not None:
-            total_operands += 1
-
+            op_a = op_a.upper()
         if op_b is not None:
-            total_operands += 1
+            op_b = op_b.upper()
+
+        check_ops(opcode, op_type, op_a, op_b)
 
-        if op_type == 0 or op_type == 1 or op_type == 2:
-            # 0, 1, or 2 register operands
-            check_ops_count(op_type, total_operands)
+        if annotate:
+            if op_b is not None:
+                listing.append((len(program), f"{opcode} {op_a},{op_b}"))
+            elif op_a is not None:
+                listing.append((len(program), f"{opcode} {op_a}"))
+            else:
+                listing.append((len(program), opcode))
 
-        elif op_type == 8:
-            # LDI r,i or LDI r,label
-            check_ops_count(2, total_operands)
+        if starts is not None:
+            starts.append(len(program))
 
-    # Type to function mapping
-    type_f = {
-        0: out0,
-        1: out1,
-        2: out2,
-        8: out8,
-    }
+        if op_type == 0:
+            program.append(machine_code)
 
-    for line in inputfile:
-        line_num += 1
+        elif op_type == 1:
+            program.append(machine_code)
+            program.append(get_reg(op_a))
 
-        # Strip comments
-        comment_index = line.find(';')
-        if comment_index != -1:
-            line = line[:comment_index]
+        elif op_type == 2:
+            program.append(machine_code)
+            program.append(get_reg(op_a))
+            program.append(get_reg(op_b))
 
-        # Normalize
-        line = line.strip()
+        else:
+            # LDI: an immediate value, or a symbol to fill in later
+            program.append(machine_code)
+            program.append(get_reg(op_a))
 
-        # Ignore blank lines
-        if input == '':
-            continue
+            try:
+                program.append(int(op_b, 0) & 0xff)
 
-        # print(line)  # debug
+            except ValueError:
+                fixups.append((len(program), op_b))
+                program.append(0)
 
-        m = re.match(REGEX, line)
+                if refs is not None:
+                    refs.setdefault(op_b, where())
 
-        if m is not None:
-            label, opcode, op_a, op_b = normalize_line(m.groups())
 
-            # print(label, opcode, op_a, op_b)  # debug
+def peephole(program, sym, fixups, starts, listing=None):
+    """
+    Peephole optimizer, run between the passes on pass1's output
+
+    * Drop LDIs that load a value the register already holds
+    * Drop LDIs whose value is overwritten before anything reads it
+    * Cancel PUSH Rn immediately followed by POP Rn
+    * Drop jumps to the instruction right after them
+    * Move the labels, fixups and listing to the shrunk code
+
+    Works one basic block at a time: every label starts a block, since
+    anything may jump to it. Code addresses must come from labels, as
+    numbers in the source don't move with the code. Returns the number of
+    bytes saved and of instructions removed; each removed instruction is
+    one cycle saved every time that code runs.
+    """
 
-            # Track label address
-            if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
-
-            if opcode is not None:
-                if opcode == 'DS':
-                    handle_ds(line)
-                elif opcode == 'DB':
-                    handle_db(line)
+    # Start offset -> (name, operand A, operand B) for every instruction
+    code = {}
+    for start in starts:
+        op = program[start]
+        code[start] = (OPCODE_NAMES[op], *program[start + 1:start + 1 + (op >> 6)])
+
+    # Symbols used as LDI operands, by the offset of the LDI
+    loads = {offset - 2: s for offset, s in fixups}
+
+    # Blocks: runs of back to back instructions, split at labels and after
+    # anything that transfers control
+    leaders = set(sym.values())
+    blocks = []
+    block = []
+    for start in starts:
+        if start in leaders or (block and block[-1] + size(program[block[-1]]) != start):
+            blocks.append(block)
+            block = []
+        block.append(start)
+        if code[start][0] in BLOCK_ENDS:
+            blocks.append(block)
+            block = []
+    blocks.append(block)
+
+    removed = set()
+
+    def following(offset):
+        """Where execution continues after offset, skipping removed code"""
+        while offset in removed:
+            offset += size(program[offset])
+        return offset
+
+    # Each removal can uncover another, so go until nothing changes
+    changed = True
+    while changed:
+        changed = False
+
+        for block in blocks:
+            # Known register values (numbers, or symbol names), and LDIs
+            # nothing has read yet
+            known = {}
+            unread = {}
+            live = [start for start in block if start not in removed]
+
+            for i, start in enumerate(live):
+                name, *operands = code[start]
+
+                if name == "LDI":
+                    reg = operands[0]
+                    value = loads.get(start, operands[1])
+
+                    if reg not in GENERAL_REGISTERS:
+                        continue
+
+                    # Already holds it
+                    if known.get(reg) == value:
+                        removed.add(start)
+                        changed = True
+                        continue
+
+                    # The previous load was never used
+                    if reg in unread:
+                        removed.add(unread[reg])
+                        changed = True
+
+                    unread[reg] = start
+                    known[reg] = value
+                    continue
+
+                if name == "PUSH" and i + 1 < len(live):
+                    after = live[i + 1]
+                    if code[after][0] == "POP" and code[after][1] == operands[0]:
+                        removed.add(start)
+                        removed.add(after)
+                        changed = True
+                        break
+
+                if name in BLOCK_ENDS:
+                    # Jumping to where we'd go anyway
+                    if name[0] == "J" and known.get(operands[0]) in sym and \
+                            following(sym[known[operands[0]]]) == \
+                            following(start + size(program[start])):
+                        removed.add(start)
+                        changed = True
+                    break
+
+                # Registers read and written
+                if name in ("POP",):
+                    reads, writes = (), operands[:1]
+                elif name == "LD":
+                    reads, writes = operands[1:], operands[:1]
+                elif name in ("ST", "CMP", "PRN", "PRA", "PUSH"):
+                    reads, writes = operands, ()
+                elif name == "NOP":
+                    reads, writes = (), ()
                 else:
-                    # Check operand count
-                    check_ops(opcode, op_a, op_b)
-
-                    # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
+                    # The ALU: registerA is read and written
+                    reads, writes = operands, operands[:1]
+
+                for reg in reads:
+                    unread.pop(reg, None)
+
+                for reg in writes:
+                    # Overwritten without being read
+                    if reg in unread:
+                        removed.add(unread.pop(reg))
+                        changed = True
+
+                    value = None
+                    fold = FOLDS.get(name)
+                    if fold is not None:
+                        a = known.get(operands[0])
+                        b = known.get(operands[-1])
+                        if isinstance(a, int) and isinstance(b, int):
+                            value = fold(a, b) & 0xff
+
+                    if value is None:
+                        known.pop(reg, None)
+                    else:
+                        known[reg] = value
+
+            # Everything could be read after the block, so leftover
+            # unread LDIs stay
+
+    if not removed:
+        return 0, 0
+
+    # Old offset -> new offset; removed code maps to whatever follows it
+    remap = []
+    shrunk = bytearray()
+    offset = 0
+    while offset < len(program):
+        if offset in removed:
+            length = size(program[offset])
+            remap.extend([len(shrunk)] * length)
+            offset += length
         else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+            remap.append(len(shrunk))
+            shrunk.append(program[offset])
+            offset += 1
+    remap.append(len(shrunk))
+
+    saved = len(program) - len(shrunk)
+    program[:] = shrunk
+
+    for s, address in sym.items():
+        sym[s] = remap[address]
+
+    fixups[:] = [
+        (remap[offset], s) for offset, s in fixups if offset - 2 not in removed
+    ]
+
+    if listing is not None:
+        notes = []
+        for offset, note in listing:
+            if note[0] == '#':
+                # Labels show their address
+                label = note[2:note.index(' (')]
+                notes.append((remap[offset], f'# {label} (address {remap[offset]}):'))
+            elif offset not in removed:
+                notes.append((remap[offset], note))
+        listing[:] = notes
+
+    return saved, len(removed)
 
 
-def pass2(outputfile, sym, code):
+def size(op):
+    """Bytes in the instruction with opcode op"""
+    return (op >> 6) + 1
+
+
+def pass2(program, sym, fixups, refs=None):
     """
-    Output the code, substituting in any symbols.
+    Substitute in the symbols. refs, from pass1, says where each one was
+    used, for the error about an unknown one.
     """
 
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
+    for offset, s in fixups:
+        if s not in sym:
+            where = (refs or {}).get(s, "<unknown>")
+            print(f"{where}: unknown symbol {s}", file=sys.stderr)
+            sys.exit(2)
 
-            if s in sym:
-                c = p8(sym[s])
+        program[offset] = sym[s] & 0xff
 
-            else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
 
-        outputfile.write(f"{c}\n")
+def optimize_program(program, sym, fixups, starts, listing=None, report=False):
+    """Run the peephole optimizer, and say what it saved if asked."""
+
+    saved, removed = peephole(program, sym, fixups, starts, listing)
+
+    if report:
+        print(f"peephole: removed {removed} instructions, saved {saved} bytes "
+              f"and ~{removed} cycles per pass through the code", file=sys.stderr)
+
+
+def check_size(program, path, limit):
+    """Reject a program that won't fit in limit bytes (None for any size)."""
+
+    if limit is not None and len(program) > limit:
+        print(f"{path or '<stdin>'}: program is {len(program)} bytes, "
+              f"more than the {limit} bytes of memory", file=sys.stderr)
+        sys.exit(2)
+
+
+def assemble(inputfile, listing=False, optimize=False, report=False,
+             limit=MEMORY_SIZE):
+    """
+    Assemble source lines. Returns the program as a bytearray, the symbol
+    table, and the annotated listing if asked for (None otherwise). With
+    optimize, the peephole optimizer runs between the passes, and report
+    prints what it saved. Programs longer than limit bytes are an error.
+    """
+
+    sym = {}
+    program = bytearray()
+    fixups = []
+    notes = [] if listing else None
+    starts = [] if optimize else None
+
+    path = getattr(inputfile, "name", None)
+    refs = {}
+
+    pass1(preprocess(inputfile, path), sym, program, fixups, notes, starts, refs)
+    if optimize:
+        optimize_program(program, sym, fixups, starts, notes, report)
+    check_size(program, path, limit)
+    pass2(program, sym, fixups, refs)
+
+    return program, sym, notes
+
+
+def compile_object(inputfile, path=None, optimize=False, report=False,
+                   limit=MEMORY_SIZE):
+    """
+    Assemble a library. Returns its code, symbols and fixups, with the
+    fixups unresolved since they may refer to symbols of the program it
+    gets linked into.
+    """
+
+    sym = {}
+    program = bytearray()
+    fixups = []
+    starts = [] if optimize else None
+
+    pass1(preprocess(inputfile, path), sym, program, fixups, None, starts)
+    if optimize:
+        optimize_program(program, sym, fixups, starts, None, report)
+    check_size(program, path, limit)
+
+    return program, sym, fixups
+
+
+def load_object(path):
+    """
+    A library to link: an object file, or a source assembled on the spot.
+    Kept for the rest of the process, so linking the same library into
+    many programs reads it only once.
+    """
+
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        print(f"can't link {path}", file=sys.stderr)
+        sys.exit(2)
+
+    cached = OBJECTS.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    if path.endswith(OBJECT_EXTENSION):
+        obj = read_object(path)
+    else:
+        with open(path) as f:
+            obj = compile_object(f, path)
+
+    OBJECTS[path] = (mtime, obj)
+    return obj
+
+
+def read_object(path):
+    """
+    Read a library object file. Returns its code, symbols and fixups.
+    """
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    pos = OBJECT_HEADER.size
+
+    def entries(count):
+        """(offset, name) pairs"""
+
+        nonlocal pos
+
+        result = []
+
+        for _ in range(count):
+            offset, length = OBJECT_ENTRY.unpack_from(data, pos)
+            pos += OBJECT_ENTRY.size
+            result.append((offset, data[pos:pos + length].decode("ascii")))
+            pos += length
+
+        return result
+
+    try:
+        magic, version, length, sym_count, fixup_count = \
+            OBJECT_HEADER.unpack_from(data)
+
+        if magic != OBJECT_MAGIC or version != OBJECT_VERSION:
+            raise ValueError
+
+        code = data[pos:pos + length]
+        pos += length
+
+        sym = {s: offset for offset, s in entries(sym_count)}
+        fixups = entries(fixup_count)
+
+    except (struct.error, UnicodeDecodeError, ValueError):
+        print(f"{path}: not an LS-8 object", file=sys.stderr)
+        sys.exit(2)
+
+    return code, sym, fixups
+
+
+def write_object(outputfile, program, sym, fixups):
+    """
+    Output a library object: the code, the symbols, and the unresolved
+    fixups.
+    """
+
+    outputfile.write(OBJECT_HEADER.pack(
+        OBJECT_MAGIC, OBJECT_VERSION, len(program), len(sym), len(fixups)))
+    outputfile.write(program)
+
+    entries = [(offset, s) for s, offset in sym.items()] + fixups
+
+    for offset, s in entries:
+        s = s.encode("ascii")
+        outputfile.write(OBJECT_ENTRY.pack(offset, len(s)) + s)
+
+
+def write_text(outputfile, program, listing=None):
+    """
+    Output the program as text, one byte per line. With a listing, label
+    lines and instruction annotations go in as comments.
+    """
+
+    lines = []
+    pos = 0
+
+    for offset, note in listing or ():
+        # Operand bytes have no annotation of their own
+        while pos < offset:
+            lines.append(BINARY[program[pos]])
+            pos += 1
+
+        if note[0] == '#':
+            lines.append(note)
+        else:
+            lines.append(f"{BINARY[program[pos]]} # {note}")
+            pos += 1
+
+    lines.extend(BINARY[b] for b in program[pos:])
+
+    lines.append('')
+    outputfile.write('\n'.join(lines))
+
+
+def write_image(outputfile, program, sym):
+    """
+    Output the program as a binary image.
+    """
+
+    # Programs load at 0 and start at their first byte
+    outputfile.write(IMAGE_HEADER.pack(
+        IMAGE_MAGIC, IMAGE_VERSION, 0, 0, len(program), len(sym)))
+    outputfile.write(program)
+
+    for name, address in sym.items():
+        name = name.encode("ascii")
+        outputfile.write(bytes([address & 0xff, len(name)]) + name)
 
 
 def main(argv):
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    inputfile, outputfile, optimize = parse_commandline(argv)
 
     # Open files
     inputfile, outputfile = open_files(inputfile, outputfile)
 
-    # Set up the symbol table
-    sym = {}
+    # Only the text output needs the annotated listing
+    image = outputfile.name.endswith(IMAGE_EXTENSION)
+    library = outputfile.name.endswith(OBJECT_EXTENSION)
+
+    # Libraries keep their fixups for the programs they're linked into
+    if library:
+        program, sym, fixups = compile_object(
+            inputfile, inputfile.name, optimize, report=True)
+        write_object(outputfile, program, sym, fixups)
+        return 0
 
-    # Set up the machine code output
-    code = []
+    program, sym, listing = assemble(
+        inputfile, not image, optimize, report=True)
 
-    # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    if image:
+        write_image(outputfile, program, sym)
+    else:
+        write_text(outputfile, program, listing)
 
     return 0
 
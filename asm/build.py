@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+"""Incremental build: assemble only the sources that changed, in parallel."""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import os
+import sys
+
+import asm
+
+"""
+Every source gets a key: the hash of its text and of everything it
+pulls in with .include and .link, the assembler's own source, the output
+format and whether it was optimized. Assembled outputs are
+kept in a content-addressed cache under that key, so anything whose key
+has been built before (by any checkout, on any branch) is a copy, not an
+assembly. Outputs that already hold the right bytes aren't rewritten at
+all.
+
+    python build.py -o ../ls8/examples *.asm
+"""
+
+# Default cache location, relative to where the build runs
+CACHE_DIR = ".asmcache"
+
+# Output file types
+EXTENSIONS = {
+    "text": ".ls8",
+    "image": asm.IMAGE_EXTENSION,
+    "object": asm.OBJECT_EXTENSION,
+}
+
+# Changing the assembler invalidates everything it has built
+with open(asm.__file__, "rb") as f:
+    ASSEMBLER_HASH = hashlib.sha256(f.read()).hexdigest()
+
+
+def find_sources(paths):
+    """
+    Expand the command line paths into (source, output name) pairs.
+    Directories contribute every .asm file under them, keeping their
+    layout in the output directory.
+    """
+
+    sources = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                # Don't build the cache
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+                for name in sorted(files):
+                    if name.endswith(".asm"):
+                        source = os.path.join(root, name)
+                        sources.append((source, os.path.relpath(source, path)))
+        else:
+            sources.append((path, os.path.basename(path)))
+
+    return sources
+
+
+def dependencies(source):
+    """
+    The files a source pulls in with .include and .link, and the files
+    those pull in, in the order they're found.
+    """
+
+    found = []
+    pending = [source]
+    seen = {source}
+
+    while pending:
+        path = pending.pop(0)
+
+        # Objects are already assembled
+        if path.endswith(asm.OBJECT_EXTENSION):
+            continue
+
+        try:
+            f = open(path)
+        except OSError:
+            # The assembler will say so
+            continue
+
+        with f:
+            for line in f:
+                m = asm.PATTERN_DIRECTIVE.match(line.split(';', 1)[0].strip())
+                if m is None or m.group(1).upper() not in ("INCLUDE", "LINK"):
+                    continue
+
+                name = m.group(2).strip().strip('"')
+                dependency = os.path.join(os.path.dirname(path), name)
+                if dependency not in seen:
+                    seen.add(dependency)
+                    found.append(dependency)
+                    pending.append(dependency)
+
+    return found
+
+
+def source_key(source, format="text", optimize=False):
+    """The cache key for assembling a source to the given output format."""
+
+    h = hashlib.sha256()
+    h.update(ASSEMBLER_HASH.encode("ascii"))
+    h.update(format.encode("ascii"))
+    h.update(b"-O" if optimize else b"")
+
+    with open(source, "rb") as f:
+        h.update(f.read())
+
+    for path in dependencies(source):
+        h.update(path.encode())
+        try:
+            with open(path, "rb") as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        except OSError:
+            h.update(b"missing")
+
+    return h.hexdigest()
+
+
+def cache_path(cache, key):
+    # Fan out over subdirectories so no directory gets huge
+    return os.path.join(cache, key[:2], key)
+
+
+def assemble_source(job):
+    """
+    Worker: assemble one source. Returns (source, output bytes, None) or
+    (source, None, error message).
+    """
+
+    source, format, optimize = job
+
+    # The assembler reports errors on stderr and exits
+    errors = io.StringIO()
+
+    try:
+        with contextlib.redirect_stderr(errors), open(source) as f:
+            if format == "object":
+                program, sym, fixups = asm.compile_object(f, source, optimize)
+            else:
+                program, sym, listing = asm.assemble(f, format == "text", optimize)
+
+    except SystemExit:
+        return source, None, errors.getvalue().strip()
+
+    except OSError as e:
+        return source, None, str(e)
+
+    if format == "object":
+        output = io.BytesIO()
+        asm.write_object(output, program, sym, fixups)
+        return source, output.getvalue(), None
+
+    if format == "image":
+        output = io.BytesIO()
+        asm.write_image(output, program, sym)
+        return source, output.getvalue(), None
+
+    output = io.StringIO()
+    asm.write_text(output, program, listing)
+    return source, output.getvalue().encode(), None
+
+
+def write_if_changed(path, data):
+    """Write a file, unless it already holds exactly these bytes."""
+
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    # Write then rename, so nobody ever sees half a file
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "wb") as f:
+        f.write(data)
+    os.replace(temp, path)
+    return True
+
+
+def build(sources, outdir, cache=CACHE_DIR, format="text", jobs=None,
+          optimize=False):
+    """
+    Bring every output up to date. Returns counts of outputs that were
+    up to date, copied from the cache, assembled, and that failed.
+    """
+
+    extension = EXTENSIONS[format]
+    counts = {"up to date": 0, "cached": 0, "assembled": 0, "failed": 0}
+
+    # Output path and cache key of every source not in the cache yet
+    misses = {}
+
+    for source, name in sources:
+        output = os.path.join(outdir, os.path.splitext(name)[0] + extension)
+        key = source_key(source, format, optimize)
+
+        try:
+            with open(cache_path(cache, key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            misses[source] = (output, key)
+            continue
+
+        if write_if_changed(output, data):
+            counts["cached"] += 1
+        else:
+            counts["up to date"] += 1
+
+    if not misses:
+        return counts
+
+    # Libraries linked from source are assembled once per worker
+    work = [(source, format, optimize) for source in misses]
+
+    # Small builds aren't worth starting workers for
+    if jobs == 1 or len(work) == 1:
+        results = map(assemble_source, work)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(assemble_source, work, 8)
+
+    try:
+        for source, data, error in results:
+            if error is not None:
+                print(f"{source}: {error}", file=sys.stderr)
+                counts["failed"] += 1
+                continue
+
+            output, key = misses[source]
+            write_if_changed(cache_path(cache, key), data)
+            write_if_changed(output, data)
+            counts["assembled"] += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return counts
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="build.py",
+        description="Assemble .asm sources, reusing cached outputs of unchanged ones.")
+    parser.add_argument("paths", nargs="*", default=["."],
+                        help="source files or directories (default: .)")
+    parser.add_argument("-o", "--output", default=".",
+                        help="directory for the assembled programs (default: .)")
+    parser.add_argument("--cache", default=CACHE_DIR,
+                        help=f"cache directory (default: {CACHE_DIR})")
+    formats = parser.add_mutually_exclusive_group()
+    formats.add_argument("--image", action="store_true",
+                         help="build .ls8b binary images instead of text")
+    formats.add_argument("--object", action="store_true",
+                         help="build .ls8o library objects instead of text")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="run the peephole optimizer")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv[1:])
+
+    format = "image" if args.image else "object" if args.object else "text"
+
+    sources = find_sources(args.paths)
+    counts = build(sources, args.output, args.cache, format, args.jobs,
+                   args.optimize)
+
+    print(", ".join(f"{count} {what}" for what, count in counts.items()),
+          file=sys.stderr)
+
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,16 @@
+; Prints Hello, world! with the shared string routines
+;
+; Expected output: Hello, world!
+
+.include "lib/macros.asm"
+
+	PRINT Hello, 14      ; print 14 bytes from Hello
+	HLT                  ; halt
+
+; The library's code goes here
+.link "lib/string.asm"
+
+Hello:
+
+	ds Hello, world!
+	db 0x0a             ; newline
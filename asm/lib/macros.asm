@@ -0,0 +1,20 @@
+; Common idioms, to .include into programs
+
+; Call a label, through a register
+.macro CALLL label, reg
+	LDI reg,label
+	CALL reg
+.endm
+
+; Jump to a label, through a register
+.macro JMPL label, reg
+	LDI reg,label
+	JMP reg
+.endm
+
+; Print a string of a given length (needs lib/string.asm linked in)
+.macro PRINT string, length
+	LDI R0,string
+	LDI R1,length
+	CALLL PrintStr, R2
+.endm
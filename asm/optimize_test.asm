@@ -0,0 +1,33 @@
+; Exercise the peephole optimizer (asm.py -O)
+;
+; Every case it handles is here once. The program prints the same with
+; and without -O; -O removes 6 instructions and 15 bytes.
+;
+; Expected output:
+; 10
+; 20
+; A
+
+	LDI R0,5
+	LDI R0,7        ; previous LDI dead
+	LDI R1,3
+	LDI R1,3        ; redundant
+	ADD R0,R1
+	LDI R2,10
+	ADD R2,R2       ; R2 = 20 known
+	LDI R2,20       ; redundant after folding
+	PRN R0
+	PRN R2
+	PUSH R0
+	POP R0          ; cancels
+	LDI R3,Next
+	JMP R3          ; jump to next
+Next:
+	LDI R3,Next     ; new block, kept
+	LDI R4,Msg
+	LD R0,R4
+	PRA R0
+	HLT
+
+Msg:
+	DB 0x41
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""Batch runner: execute many LS-8 programs across a process pool."""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from cpu import *
+from compiler import BlockCompiler
+from sinks import ListSink
+
+# File types the batch runner picks up from a directory
+PROGRAM_EXTENSIONS = (".ls8", ".ls8b", ".bin")
+
+
+def find_programs(paths):
+    """
+    Expand the command line paths into a list of program files. Directories
+    contribute every program file in them, any other file is a manifest
+    listing one program per line (unless it's a program itself).
+    """
+
+    programs = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(PROGRAM_EXTENSIONS):
+                    programs.append(os.path.join(path, name))
+
+        elif path.endswith(PROGRAM_EXTENSIONS):
+            programs.append(path)
+
+        else:
+            # Manifest: paths are relative to the manifest itself
+            base = os.path.dirname(path)
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+
+                    # Bypass blank lines and comments
+                    if line == "" or line[0] == "#":
+                        continue
+
+                    programs.append(os.path.join(base, line))
+
+    return programs
+
+
+def load_program(cpu, path):
+    """
+    Load a .ls8 program or .ls8b image, or copy a raw .bin RAM image into
+    memory.
+    """
+
+    if path.endswith(".bin"):
+        with open(path, "rb") as f:
+            image = f.read(len(cpu.ram))
+        cpu.ram[:len(image)] = image
+    else:
+        cpu.load(path)
+
+
+def run_program(job):
+    """
+    Worker: run one program and return its result record. Everything the
+    program prints is captured in memory rather than written to our stdout.
+    """
+
+    path, engine, max_cycles, timeout = job
+
+    cpu = CPU()
+    output = ListSink()
+    cpu.output = output
+    status = None
+    error = None
+
+    start = time.perf_counter()
+
+    try:
+        load_program(cpu, path)
+
+        if engine == "block":
+            result = BlockCompiler(cpu).run(max_cycles, timeout=timeout)
+        else:
+            result = cpu.run(max_cycles, timeout=timeout)
+
+        status = result.reason
+
+    except LoadError as e:
+        status = "load_error"
+        error = str(e)
+
+    except Exception as e:
+        status = "error"
+        error = f"{type(e).__name__}: {e}"
+
+    wall_time = time.perf_counter() - start
+
+    return {
+        "program": path,
+        "status": status,
+        "error": error,
+        "output": output.getvalue(),
+        "cycles": cpu.cycles,
+        "wall_time": wall_time,
+        "pc": cpu.pc,
+        "registers": list(cpu.reg),
+        "flags": cpu.FL,
+    }
+
+
+def parse_commandline(argv):
+    """Parse the batch runner's command line."""
+
+    parser = argparse.ArgumentParser(
+        prog="batch.py",
+        description="Run many LS-8 programs and write one JSON result per line.")
+    parser.add_argument("paths", nargs="+",
+                        help="program files, directories of programs, or manifests")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="JSONL results file (default: stdout)")
+    parser.add_argument("--engine", choices=("interp", "block"), default="interp",
+                        help="execution engine (default: interp)")
+    parser.add_argument("--max-cycles", type=int, default=None,
+                        help="stop each program after this many instructions")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="stop each program after this many seconds")
+    parser.add_argument("--chunksize", type=int, default=16,
+                        help="programs handed to a worker at a time")
+
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    programs = find_programs(args.paths)
+    jobs = [
+        (path, args.engine, args.max_cycles, args.timeout)
+        for path in programs
+    ]
+
+    if args.output == "-":
+        outputfile = sys.stdout
+    else:
+        outputfile = open(args.output, "w")
+
+    # Results come back in program order, so runs are easy to compare
+    with multiprocessing.Pool(args.jobs) as pool:
+        for result in pool.imap(run_program, jobs, args.chunksize):
+            outputfile.write(json.dumps(result) + "\n")
+
+    if outputfile is not sys.stdout:
+        outputfile.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
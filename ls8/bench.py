@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for the LS-8 emulator engines and the assembler."""
+
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from cpu import *
+from compiler import BlockCompiler
+from sinks import NullSink
+
+# The assembler lives next door in asm/
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "asm"))
+import asm
+
+# Engines every program is run on
+ENGINES = ("interp", "block")
+
+# Programs that never halt are cut off after this many instructions
+MAX_CYCLES = 2_000_000
+
+# Copies of the instruction under test in each opcode kernel
+OPCODE_COPIES = 32
+
+
+"""
+    Synthetic kernels
+    -----------------
+Each kernel wraps a body in two nested countdown loops. The loops use
+R2-R4, so bodies are free to use R0 and R1 (R5-R7 are reserved by the
+spec). Code after the HLT, such as subroutines, goes in the tail.
+"""
+
+def looped(body, outer, inner, setup="", tail=""):
+    """Return assembler source that runs body outer * inner times."""
+    return f"""
+{setup}
+    LDI R2,{outer}
+Outer:
+    LDI R3,{inner}
+Inner:
+{body}
+    LDI R4,1
+    SUB R3,R4
+    LDI R4,0
+    CMP R3,R4
+    LDI R4,Inner
+    JNE R4
+    LDI R4,1
+    SUB R2,R4
+    LDI R4,0
+    CMP R2,R4
+    LDI R4,Outer
+    JNE R4
+    HLT
+{tail}
+"""
+
+
+def kernels(scale):
+    """The synthetic kernels, as name -> assembler source."""
+    outer = max(1, 10 * scale)
+
+    return {
+        # Nothing but the loop overhead
+        "loops": looped("", outer, 250),
+
+        # Recursive calls eight deep on every iteration
+        "calls": looped(
+            "    LDI R0,8\n    LDI R1,Rec\n    CALL R1",
+            outer, 25,
+            tail="""
+Rec:
+    LDI R4,0
+    CMP R0,R4
+    LDI R4,RecEnd
+    JEQ R4
+    LDI R4,1
+    SUB R0,R4
+    CALL R1
+RecEnd:
+    RET
+""",
+        ),
+
+        # Pushes and pops that always cancel out
+        "stack": looped(
+            "\n".join(["    PUSH R0", "    PUSH R1", "    POP R1", "    POP R0"] * 4),
+            outer, 100,
+        ),
+
+        # A mix of every ALU operation
+        "alu": looped(
+            """
+    LDI R0,77
+    LDI R1,3
+    ADD R0,R1
+    MUL R0,R1
+    SUB R0,R1
+    DIV R0,R1
+    MOD R0,R1
+    AND R0,R1
+    OR R0,R1
+    XOR R0,R1
+    SHL R0,R1
+    SHR R0,R1
+    NOT R0
+    CMP R0,R1
+""",
+            outer, 100,
+        ),
+    }
+
+
+def opcode_kernels(scale):
+    """
+    One kernel per measured instruction, repeating it OPCODE_COPIES times
+    per loop iteration, plus an empty baseline to subtract.
+    """
+    outer = max(1, 20 * scale)
+    inner = 250
+    setup = "    LDI R0,200\n    LDI R1,3"
+
+    bodies = {
+        "baseline": "",
+        "NOP": "    NOP",
+        "LDI": "    LDI R0,200",
+        # R0 doubles as an address well past the end of the program
+        "LD": "    LD R1,R0",
+        "ST": "    ST R0,R1",
+        "PRN": "    PRN R0",
+        "PRA": "    PRA R0",
+        "PUSH+POP": "\n".join(["    PUSH R0", "    POP R0"] * (OPCODE_COPIES // 2)),
+    }
+
+    for name in ("ADD", "SUB", "MUL", "DIV", "MOD", "CMP", "AND", "OR",
+                 "XOR", "SHL", "SHR"):
+        bodies[name] = f"    {name} R0,R1"
+    for name in ("NOT", "INC", "DEC"):
+        bodies[name] = f"    {name} R0"
+
+    sources = {}
+    for name, body in bodies.items():
+        # PUSH+POP is already written out in full
+        if name not in ("baseline", "PUSH+POP"):
+            body = "\n".join([body] * OPCODE_COPIES)
+        sources[name] = looped(body, outer, inner, setup=setup)
+
+    return sources, outer * inner * OPCODE_COPIES
+
+
+def assemble(source):
+    """Assemble source text into program bytes."""
+    return bytes(asm.assemble(source.splitlines())[0])
+
+
+"""
+    Running programs
+    ----------------
+"""
+
+def run_once(program, engine, max_cycles=MAX_CYCLES):
+    """Run a program on a fresh CPU, with output thrown away."""
+    cpu = CPU()
+    cpu.output = NullSink()
+    cpu.load_bytes(program)
+
+    if engine == "block":
+        return BlockCompiler(cpu).run(max_cycles)
+    return cpu.run(max_cycles)
+
+
+def measure(program, engine, repeat):
+    """Time a program on one engine. Keeps the best of repeat runs."""
+    best = None
+
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = run_once(program, engine)
+            seconds = time.perf_counter() - start
+
+            if best is None or seconds < best:
+                best = seconds
+
+        # Measure memory separately, tracemalloc slows everything down
+        tracemalloc.start()
+        run_once(program, engine)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    except LS8Error as e:
+        return {"status": "error", "error": str(e)}
+    except Exception as e:
+        return {"status": "error", "error": f"{type(e).__name__}: {e}"}
+
+    return {
+        "status": result.reason,
+        "instructions": result.cycles,
+        "seconds": best,
+        "instructions_per_sec": result.cycles / best if best else None,
+        "peak_memory": peak,
+    }
+
+
+def bench_programs(programs, repeat):
+    """Run every program on every engine."""
+    results = {}
+
+    for name, program in programs.items():
+        results[name] = {
+            engine: measure(program, engine, repeat) for engine in ENGINES
+        }
+
+    return results
+
+
+def bench_opcodes(scale, repeat):
+    """Nanoseconds per instruction for each measured opcode, per engine."""
+    sources, count = opcode_kernels(scale)
+    programs = {name: assemble(source) for name, source in sources.items()}
+
+    results = {}
+
+    for engine in ENGINES:
+        timings = {
+            name: measure(program, engine, repeat)
+            for name, program in programs.items()
+        }
+        baseline = timings.pop("baseline")
+
+        results[engine] = {}
+        for name, timing in timings.items():
+            if "seconds" not in timing or "seconds" not in baseline:
+                results[engine][name] = None
+                continue
+            extra = timing["seconds"] - baseline["seconds"]
+            results[engine][name] = max(extra, 0) / count * 1e9
+
+    return results
+
+
+"""
+    Assembler workloads
+    -------------------
+"""
+
+def generated_source(lines):
+    """Machine-written assembler source of roughly the given length."""
+    out = []
+
+    for i in range(lines // 8):
+        out.append(f"Label{i}:")
+        out.append(f"    LDI R{i % 5},{i % 256}  ; load something")
+        out.append("    ADD R0,R1")
+        out.append(f"    LDI R4,Label{i}")
+        out.append("    CMP R0,R1")
+        out.append("    JNE R4")
+        out.append("    PUSH R2")
+        out.append("    POP R3")
+
+    out.append("    HLT")
+    out.append("    DS Hello, world!")
+    out.append("    DB 0x0a")
+
+    return out
+
+
+def bench_assembler(lines, repeat):
+    """Assemble a large generated file to text and to an image."""
+    source = generated_source(lines)
+    results = {"lines": len(source)}
+
+    # Far too big to run, it's only for timing the assembler
+    def text():
+        program, sym, listing = asm.assemble(source, listing=True, limit=None)
+        asm.write_text(io.StringIO(), program, listing)
+
+    def image():
+        program, sym, listing = asm.assemble(source, limit=None)
+        asm.write_image(io.BytesIO(), program, sym)
+
+    for output, run in (("text", text), ("image", image)):
+        best = None
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+
+            if best is None or seconds < best:
+                best = seconds
+
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[output] = {
+            "seconds": best,
+            "lines_per_sec": len(source) / best,
+            "peak_memory": peak,
+        }
+
+    return results
+
+
+"""
+    Reporting
+    ---------
+"""
+
+def metadata(args):
+    """Where and when these numbers were taken."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE, capture_output=True, text=True,
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "scale": args.scale,
+        "repeat": args.repeat,
+    }
+
+
+def flatten(results, prefix=""):
+    """Flatten nested results into {"a/b/c": number} for comparisons."""
+    flat = {}
+
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}/"))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+
+    return flat
+
+
+def compare(old, new):
+    """Print the change in every throughput and timing shared by two runs."""
+    old = flatten(old)
+    new = flatten(new)
+
+    print(f"{'metric':60} {'old':>12} {'new':>12} {'change':>8}")
+
+    for key in sorted(set(old) & set(new)):
+        # Only the numbers that say how fast something is
+        if not key.endswith(("_per_sec", "seconds")) and "/opcodes/" not in f"/{key}":
+            continue
+        if old[key] == 0:
+            continue
+
+        change = new[key] / old[key]
+        print(f"{key:60} {old[key]:12.4g} {new[key]:12.4g} {change:7.2f}x")
+
+
+def summary(results):
+    """Print the headline numbers."""
+    for section in ("programs", "kernels"):
+        print(f"== {section}")
+        for name, engines in results[section].items():
+            cells = []
+            for engine, r in engines.items():
+                if r.get("instructions_per_sec"):
+                    cells.append(f"{engine} {r['instructions_per_sec'] / 1e6:7.2f}M ips")
+                else:
+                    cells.append(f"{engine} {r['status']}")
+            print(f"  {name:32} " + "  ".join(cells))
+
+    print("== ns/instruction")
+    for engine, timings in results["opcodes"].items():
+        cells = " ".join(
+            f"{name}={ns:.0f}" for name, ns in timings.items() if ns is not None)
+        print(f"  {engine:8} {cells}")
+
+    print("== assembler")
+    a = results["assembler"]
+    for output in ("text", "image"):
+        print(f"  {output:8} {a[output]['lines_per_sec']:10.0f} lines/sec "
+              f"({a['lines']} lines, peak {a[output]['peak_memory']} bytes)")
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        prog="bench.py", description="Benchmark the LS-8 engines and assembler.")
+    parser.add_argument("-o", "--output", help="write the results as JSON here")
+    parser.add_argument("--compare", metavar="OLD.json",
+                        help="compare against an earlier results file")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="make the synthetic kernels this many times longer")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per measurement, the best one is kept")
+    parser.add_argument("--asm-lines", type=int, default=20000,
+                        help="size of the generated assembler workload")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    # The shipped example programs
+    programs = {}
+    for path in sorted(glob.glob(os.path.join(HERE, "examples", "*.ls8"))):
+        cpu = CPU()
+        cpu.load_file(path)
+        programs[os.path.basename(path)] = bytes(cpu.ram)
+
+    results = {
+        "meta": metadata(args),
+        "programs": bench_programs(programs, args.repeat),
+        "kernels": bench_programs(
+            {name: assemble(source) for name, source in kernels(args.scale).items()},
+            args.repeat),
+        "opcodes": bench_opcodes(args.scale, args.repeat),
+        "assembler": bench_assembler(args.asm_lines, args.repeat),
+    }
+
+    summary(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        compare(old, results)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
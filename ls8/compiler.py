@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+"""Basic-block compiler: runs LS-8 code as generated Python functions."""
+
+import re
+import sys
+from cpu import *
+from sinks import BufferedSink
+
+"""
+A basic block is a run of straight-line instructions that ends at the first
+instruction that sets the PC (bit C of the opcode: CALL, RET, JMP, JEQ, JNE,
+...) or at HLT. Each block is turned into one Python function that keeps the
+registers and the packed flags (00000LGE) in local variables and returns the
+address of the next block to run.
+"""
+
+# Longest block we will build, in instructions
+MAX_BLOCK = 64
+
+# Matches a register local (r0-r7) in generated code
+REGISTER_NAME = re.compile(r"\br([0-7])\b")
+# Matches the flags local in generated code
+FLAG_NAME = re.compile(r"\bfl\b")
+
+# Flag bits each conditional jump tests (JEQ and JNE are handled apart)
+CONDITIONS = {
+    JGT: 0b010,
+    JLT: 0b100,
+    JLE: 0b101,
+    JGE: 0b011,
+}
+
+# Stands in for a block start in owners at memory-mapped addresses, so
+# compiled stores to them take the invalidate() path to the device
+MAPPED = -1
+
+# Marker for a block exit in the generated body, expanded once we know
+# which registers and flags the block touches
+EXIT = object()
+
+
+class BlockCompiler:
+    """Execution engine that compiles and caches basic blocks."""
+
+    def __init__(self, cpu):
+        """Construct a block compiler for the given CPU."""
+        self.cpu = cpu
+        # Compiled blocks, keyed by start address
+        self.blocks = {}
+        # For every byte of memory, the start addresses of the blocks
+        # that were compiled from it
+        self.owners = [set() for _ in range(256)]
+        # Drop everything when the CPU gets new code, and the blocks built
+        # from a byte whenever the interpreter, an interrupt or a device
+        # writes it
+        cpu.watchers.append(self.flush)
+        cpu.address_watchers.append(self.discard)
+        # Mark the addresses devices are mapped at
+        self.flush()
+
+    """
+    ---------- Code generation ----------
+    """
+    def emit(self, address, ir, operand_a, operand_b, next_pc):
+        """
+        Return the body lines for one instruction, or None if it can't be
+        compiled. Each line is an (indent, text) pair, or an
+        (indent, EXIT, pc expression) marker. compile() adds the number of
+        instructions completed to each marker.
+        """
+        a = f"r{operand_a}"
+        b = f"r{operand_b}"
+
+        # Operands that aren't register numbers are left to the interpreter
+        # (LDI's second operand is an immediate, so only check the first)
+        if ir >> 6 >= 1 and operand_a > 7:
+            return None
+        if ir >> 6 == 2 and ir != LDI and operand_b > 7:
+            return None
+
+        # ALU instructions come straight from the CPU's ALU table
+        if ir & 0b00100000 and ir in self.cpu.branchtable:
+            name, function, expression = ALU_OPS[ir & 0x0F]
+            value = "(" + expression.format(a=a, b=b) + ")"
+
+            if name == "CMP":
+                return [(0, f"fl = {value}")]
+
+            if name in ("DIV", "MOD"):
+                # Same zero check the ALU makes: print an error and halt
+                return [
+                    (0, f"if {b} == 0:"),
+                    (1, 'print("Second value can not be 0", file=sys.stderr)'),
+                    (1, "cpu.running = False"),
+                    (1, "cpu.halt_reason = DIVIDE_BY_ZERO"),
+                    (1, EXIT, str(next_pc)),
+                    (0, f"{a} = {value} & 0xFF"),
+                ]
+
+            return [(0, f"{a} = {value} & 0xFF")]
+
+        if ir == NOP:
+            return [(0, "pass")]
+
+        if ir == LDI:
+            return [(0, f"{a} = {operand_b}")]
+
+        if ir == LD:
+            # With devices mapped, reads have to go through the bus
+            if any(self.cpu.io):
+                return [(0, f"{a} = cpu.ram_read({b})")]
+            return [(0, f"{a} = ram[{b}]")]
+
+        if ir == ST:
+            return [
+                (0, f"ram[{a}] = {b}"),
+                # Same as PUSH: code or a device at the address ends the block
+                (0, f"if owners[{a}]:"),
+                (1, f"invalidate({a})"),
+                (1, EXIT, str(next_pc)),
+            ]
+
+        if ir == PRN:
+            return [(0, f'cpu.output.write("%d\\n" % {a})')]
+
+        if ir == PRA:
+            return [(0, f"cpu.output.write(chr({a}))")]
+
+        if ir == PUSH:
+            return [
+                (0, "r7 = (r7 - 1) & 0xFF"),
+                (0, f"ram[r7] = {a}"),
+                # Writing over compiled code ends this block early
+                (0, "if owners[r7]:"),
+                (1, "invalidate(r7)"),
+                (1, EXIT, str(next_pc)),
+            ]
+
+        if ir == POP:
+            return [
+                (0, f"{a} = ram[r7]"),
+                (0, "r7 = (r7 + 1) & 0xFF"),
+            ]
+
+        if ir == HLT:
+            return [
+                (0, "cpu.running = False"),
+                (0, "cpu.halt_reason = HALTED"),
+                (0, EXIT, str(next_pc)),
+            ]
+
+        if ir == CALL:
+            return [
+                (0, "r7 = (r7 - 1) & 0xFF"),
+                (0, f"ram[r7] = {next_pc}"),
+                (0, "if owners[r7]:"),
+                (1, "invalidate(r7)"),
+                (0, EXIT, a),
+            ]
+
+        if ir == RET:
+            return [
+                (0, "ret_address = ram[r7]"),
+                (0, "r7 = (r7 + 1) & 0xFF"),
+                (0, EXIT, "ret_address"),
+            ]
+
+        if ir == JMP:
+            return [(0, EXIT, a)]
+
+        if ir == JEQ:
+            return [
+                (0, "if fl & 1:"),
+                (1, EXIT, a),
+                (0, EXIT, str(next_pc)),
+            ]
+
+        if ir == JNE:
+            return [
+                (0, "if not fl & 1:"),
+                (1, EXIT, a),
+                (0, EXIT, str(next_pc)),
+            ]
+
+        # The other conditional jumps, by the flag bits they test
+        if ir in CONDITIONS:
+            return [
+                (0, f"if fl & {CONDITIONS[ir]}:"),
+                (1, EXIT, a),
+                (0, EXIT, str(next_pc)),
+            ]
+
+        if ir == INT:
+            # The check between blocks serves it
+            return [
+                (0, f"r6 = r6 | (1 << ({a} & 7))"),
+                (0, EXIT, str(next_pc)),
+            ]
+
+        if ir == IRET:
+            # Pop R6-R0, FL and the PC that serve_interrupt() pushed
+            lines = []
+            for n in range(6, -1, -1):
+                lines.append((0, f"r{n} = ram[r7]"))
+                lines.append((0, "r7 = (r7 + 1) & 0xFF"))
+            return lines + [
+                (0, "fl = ram[r7]"),
+                (0, "ret_address = ram[(r7 + 1) & 0xFF]"),
+                (0, "r7 = (r7 + 2) & 0xFF"),
+                (0, "cpu.interrupts_enabled = True"),
+                (0, EXIT, "ret_address"),
+            ]
+
+        # Anything else is left to the interpreter
+        return None
+
+    def compile(self, start):
+        """Compile the block that starts at the given address."""
+        ram = self.cpu.ram
+        body = []
+        covered = []
+        count = 0
+
+        address = start
+        for _ in range(MAX_BLOCK):
+            # Decode the instruction the same way the interpreter does
+            ir = ram[address]
+            operand_a = ram[(address + 1) & 0xFF]
+            operand_b = ram[(address + 2) & 0xFF]
+            next_pc = (address + (ir >> 6) + 1) & 0xFF
+
+            lines = self.emit(address, ir, operand_a, operand_b, next_pc)
+            if lines is None:
+                break
+
+            # Tag each exit with the instructions completed when it's taken
+            count += 1
+            body.extend(line if len(line) == 2 else line + (count,) for line in lines)
+            covered.extend((address + i) & 0xFF for i in range((ir >> 6) + 1))
+            address = next_pc
+
+            # Stop at anything that sets the PC, or at HLT
+            if ir & 0b00010000 or ir == HLT:
+                break
+            # Stop if straight-line code wrapped back onto itself
+            if address in covered:
+                break
+
+        # Nothing compiled means the first instruction needs the interpreter
+        if not body:
+            return None
+
+        # Fall through to the next block if the last instruction didn't exit
+        if len(body[-1]) == 2 or body[-1][0] != 0:
+            body.append((0, EXIT, str(address), count))
+
+        function = self.build(start, body)
+
+        # Remember which bytes this block was compiled from
+        self.blocks[start] = function
+        for byte in covered:
+            self.owners[byte].add(start)
+
+        return function
+
+    def build(self, start, body):
+        """Turn body lines into a Python function."""
+        # Work out which locals the block touches
+        text = "\n".join(line[1] if len(line) == 2 else line[2] for line in body)
+        registers = sorted(set(REGISTER_NAME.findall(text)))
+        flags = FLAG_NAME.search(text) is not None
+
+        # Load the touched registers and the flags into locals...
+        source = [f"def block_{start:02X}(cpu, reg, ram, owners, invalidate):"]
+        for n in registers:
+            source.append(f"    r{n} = reg[{n}]")
+        if flags:
+            source.append("    fl = cpu.FL")
+
+        # ...and store them back at every exit, along with the cycle count
+        for line in body:
+            indent = "    " * (line[0] + 1)
+            if len(line) == 2:
+                source.append(indent + line[1])
+                continue
+            for n in registers:
+                source.append(f"{indent}reg[{n}] = r{n}")
+            if flags:
+                source.append(f"{indent}cpu.FL = fl")
+            source.append(f"{indent}cpu.cycles += {line[3]}")
+            source.append(f"{indent}return {line[2]}")
+
+        namespace = {
+            "sys": sys,
+            "HALTED": HALTED,
+            "DIVIDE_BY_ZERO": DIVIDE_BY_ZERO,
+        }
+        exec(compile("\n".join(source), f"<ls8 block {start:02X}>", "exec"), namespace)
+        return namespace[f"block_{start:02X}"]
+
+    def flush(self):
+        """Drop every compiled block."""
+        self.blocks.clear()
+        for owned, mapping in zip(self.owners, self.cpu.io):
+            owned.clear()
+            if mapping is not None:
+                owned.add(MAPPED)
+
+    def discard(self, address):
+        """
+        Drop every compiled block built from the given byte. CPU.invalidate()
+        calls this, so it must not call back into the CPU.
+        """
+        for start in list(self.owners[address]):
+            if start == MAPPED:
+                continue
+            self.blocks.pop(start, None)
+            # Forget the dropped block everywhere it was recorded
+            for owned in self.owners:
+                owned.discard(start)
+
+    def invalidate(self, address):
+        """Compiled code wrote to a byte that code or a device uses."""
+        address &= 0xFF
+        # Drops the blocks too, through discard()
+        self.cpu.invalidate(address)
+
+        # Compiled code stored to RAM itself, pass the value on
+        mapping = self.cpu.io[address]
+        if mapping is not None:
+            device, start = mapping
+            device.write(self.cpu, address - start, self.cpu.ram[address])
+
+    """
+    ---------- Run the CPU ----------
+    """
+    def run(self, max_cycles=None, capture=False, timeout=None):
+        """
+        Run the CPU's program one compiled block at a time. Takes the same
+        arguments and returns the same result as CPU.run(), but the cycle
+        limit is only checked between blocks, so a run can overshoot it by
+        up to one block.
+        """
+        return self.cpu.run(max_cycles, capture, self.execute, timeout)
+
+    def execute(self, limit=None):
+        """Run compiled blocks until the CPU halts or cycles reaches limit."""
+        cpu = self.cpu
+        # Start the program
+        cpu.running = True
+        cpu.halt_reason = None
+
+        # Local aliases for the hot loop
+        blocks = self.blocks
+        reg = cpu.reg
+        args = (cpu, reg, cpu.ram, self.owners, self.invalidate)
+
+        while cpu.running:
+            # Stop (resumably) once the cycle budget is spent
+            if limit is not None and cpu.cycles >= limit:
+                cpu.running = False
+                cpu.halt_reason = CYCLE_LIMIT
+                break
+
+            # Interrupts are checked between blocks, one masked test each
+            if reg[5] & reg[6] and cpu.interrupts_enabled:
+                cpu.serve_interrupt()
+
+            block = blocks.get(cpu.pc)
+            if block is None:
+                block = self.compile(cpu.pc)
+
+            if block is None:
+                # Let the interpreter execute this one instruction
+                handler, operand_a, operand_b, cpu.pc = cpu.decode(cpu.pc)
+                handler(operand_a, operand_b)
+                cpu.cycles += 1
+            else:
+                cpu.pc = block(*args)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: compiler.py program_name")
+        sys.exit(1)
+
+    cpu = CPU()
+    # Buffer output, run() flushes it when the program stops
+    cpu.output = BufferedSink(sys.stdout)
+
+    try:
+        cpu.load(sys.argv[1])
+        BlockCompiler(cpu).run()
+    except LS8Error as e:
+        print(e)
+        sys.exit(e.exit_code)
@@ -1,11 +1,19 @@
 """CPU functionality."""
 
+import struct
 import sys
+import time
+
+from sinks import ListSink
 
 """Instruction definitions"""
+NOP = 0b00000000    # No operation
 HLT = 0b00000001    # Halt
 LDI = 0b10000010    # Set value of a reg to an int
+LD = 0b10000011     # Load a reg from memory
+ST = 0b10000100     # Store a reg in memory
 PRN = 0b01000111    # Print
+PRA = 0b01001000    # Print alpha character
 PUSH = 0b01000101   # Push
 POP = 0b01000110    # Pop
 """PC mutators"""
@@ -14,12 +22,20 @@ RET = 0b00010001    # Return
 JMP = 0b01010100    # Jump
 JEQ = 0b01010101    # Jump - Equal
 JNE = 0b01010110    # Jump - Not equal
+JGT = 0b01010111    # Jump - Greater than
+JLT = 0b01011000    # Jump - Less than
+JLE = 0b01011001    # Jump - Less than or equal
+JGE = 0b01011010    # Jump - Greater than or equal
+INT = 0b01010010    # Issue an interrupt
+IRET = 0b00010011   # Return from an interrupt handler
 """ALU"""
 ADD = 0b10100000    # Add
 SUB = 0b10100001    # Subtract
 MUL = 0b10100010    # Multiply
 DIV = 0b10100011    # Divide
 MOD = 0b10100100    # Modulus
+INC = 0b01100101    # Increment
+DEC = 0b01100110    # Decrement
 CMP = 0b10100111    # Compare
 AND = 0b10101000    # Bitwise-AND
 NOT = 0b01101001    # Bitwise-NOT
@@ -37,29 +53,212 @@ C:    1 if this instruction sets the PC
 DDDD: Instruction identifier
 """
 
+# Mnemonics by opcode, for profilers, tracers and error messages
+OPCODE_NAMES = {
+    NOP: "NOP", HLT: "HLT", LDI: "LDI", LD: "LD", ST: "ST",
+    PRN: "PRN", PRA: "PRA", PUSH: "PUSH", POP: "POP",
+    CALL: "CALL", RET: "RET", JMP: "JMP", JEQ: "JEQ", JNE: "JNE",
+    JGT: "JGT", JLT: "JLT", JLE: "JLE", JGE: "JGE",
+    INT: "INT", IRET: "IRET",
+    ADD: "ADD", SUB: "SUB", MUL: "MUL", DIV: "DIV", MOD: "MOD",
+    INC: "INC", DEC: "DEC",
+    CMP: "CMP", AND: "AND", NOT: "NOT", OR: "OR", XOR: "XOR",
+    SHL: "SHL", SHR: "SHR",
+}
+
+"""
+ALU operations, keyed by the instruction identifier (DDDD) of the opcode.
+Each entry holds the mnemonic, a function of the two register values, and
+the same operation as a Python expression for code generators. Results are
+wrapped to 8 bits by whoever applies them, not here. CMP returns the packed
+flags (00000LGE) instead of a register value.
+"""
+ALU_OPS = {
+    ADD & 0x0F: ("ADD", lambda a, b: a + b, "{a} + {b}"),
+    SUB & 0x0F: ("SUB", lambda a, b: a - b, "{a} - {b}"),
+    MUL & 0x0F: ("MUL", lambda a, b: a * b, "{a} * {b}"),
+    DIV & 0x0F: ("DIV", lambda a, b: a // b, "{a} // {b}"),
+    MOD & 0x0F: ("MOD", lambda a, b: a % b, "{a} % {b}"),
+    INC & 0x0F: ("INC", lambda a, b: a + 1, "{a} + 1"),
+    DEC & 0x0F: ("DEC", lambda a, b: a - 1, "{a} - 1"),
+    CMP & 0x0F: ("CMP",
+                 lambda a, b: ((a < b) << 2) | ((a > b) << 1) | (a == b),
+                 "(({a} < {b}) << 2) | (({a} > {b}) << 1) | ({a} == {b})"),
+    AND & 0x0F: ("AND", lambda a, b: a & b, "{a} & {b}"),
+    NOT & 0x0F: ("NOT", lambda a, b: ~a, "~{a}"),
+    OR  & 0x0F: ("OR",  lambda a, b: a | b, "{a} | {b}"),
+    XOR & 0x0F: ("XOR", lambda a, b: a ^ b, "{a} ^ {b}"),
+    SHL & 0x0F: ("SHL", lambda a, b: a << b, "{a} << {b}"),
+    SHR & 0x0F: ("SHR", lambda a, b: a >> b, "{a} >> {b}"),
+}
+
+"""
+    Binary program images
+    ---------------------
+A 12-byte header, then the raw program bytes, then the symbol table.
+
+Header: magic "LS8I", version, load address, entry point, a reserved byte,
+program length (2 bytes, little-endian), symbol count (2 bytes).
+Symbols:  address (1 byte), name length (1 byte), ASCII name.
+
+asm/asm.py writes this format; keep the two in step.
+"""
+IMAGE_MAGIC = b"LS8I"
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct("<4sBBBxHH")
+IMAGE_EXTENSION = ".ls8b"
+
+"""
+    Snapshots
+    ---------
+The whole machine state as one 280-byte blob: a 16-byte header, then
+R0-R7, then all 256 bytes of RAM.
+
+Header: magic "LS8S", version, PC, FL, state bits (bit 0: halted, bit 1:
+inside an interrupt handler), instructions executed so far (8 bytes,
+little-endian).
+
+Attached devices with state of their own (ones with snapshot() and
+restore(data) methods, like BankedMemory) follow, each as a 4-byte
+length and that many bytes, in the order stateful_devices() lists them.
+"""
+SNAPSHOT_MAGIC = b"LS8S"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sBBBBQ")
+SNAPSHOT_DEVICE = struct.Struct("<I")
+SNAPSHOT_HALTED = 0b00000001
+SNAPSHOT_IN_INTERRUPT = 0b00000010
+
+"""Interrupts and the keyboard, see the spec"""
+IM = 5                      # Register holding the interrupt mask
+IS = 6                      # Register holding the interrupt status
+TIMER_INTERRUPT = 0         # Interrupt numbers (bits in IM and IS)
+KEYBOARD_INTERRUPT = 1
+KEY_ADDRESS = 0xF4          # Where the keyboard stores the last key pressed
+VECTOR_TABLE = 0xF8         # Handler addresses for I0-I7 start here
+TIMER_SECONDS = 1.0         # The timer interrupt fires once per second
+
+"""Halt reasons reported by run()"""
+HALTED = "halted"                   # HLT instruction
+CYCLE_LIMIT = "cycle_limit"         # Ran out of cycles, can be resumed
+DEADLINE = "deadline"               # Ran out of time, can be resumed
+DIVIDE_BY_ZERO = "divide_by_zero"   # DIV or MOD by a zero register
+
+
+# With a timeout, run() executes this many instructions between clock reads
+TIME_SLICE = 4096
+
+
+class LS8Error(Exception):
+    """Base class for errors raised by the emulator."""
+
+    # Exit status for command line tools that report this error
+    exit_code = 1
+
+
+class LoadError(LS8Error):
+    """A program couldn't be loaded."""
+
+    def __init__(self, message, exit_code=1):
+        super().__init__(message)
+        # Exit status for command line tools that report this error
+        self.exit_code = exit_code
+
+
+class InvalidInstruction(LS8Error):
+    """
+    The PC reached a byte that isn't a known instruction, or an instruction
+    naming a register past R7.
+    """
+
+    def __init__(self, ir, address, register=None):
+        if register is None:
+            message = f"Unknown instruction {ir:08b} at address {address:02X}"
+        else:
+            message = (f"Invalid register {register} in instruction {ir:08b} "
+                       f"at address {address:02X}")
+        super().__init__(message)
+        self.ir = ir
+        self.address = address
+        self.register = register
+
+
+class RunResult:
+    """What a call to run() did."""
+
+    def __init__(self, reason, cycles, output=None):
+        # Why execution stopped, one of the halt reasons above
+        self.reason = reason
+        # Number of instructions executed by this call
+        self.cycles = cycles
+        # Text the program printed, if run() was asked to capture it
+        self.output = output
+
+    def __repr__(self):
+        return f"RunResult({self.reason!r}, {self.cycles}, {self.output!r})"
+
+
 class CPU:
     """Main CPU class."""
 
     def __init__(self):
         """Construct a new CPU."""
         # Holds 256 bytes of memory
-        self.ram = [0] * 256
+        self.ram = bytearray(256)
         # 8 general-purpose registors
-        self.reg = [0] * 8
+        self.reg = bytearray(8)
         # Stack pointer
         self.reg[7] = 0xF4
-        # Flags: 8 bits, if a particular bit is set, that flag is "true"
-        self.FL = [0] * 8
+        # Zero-copy views of memory and the registers, for dumps and tests
+        self.ram_view = memoryview(self.ram)
+        self.reg_view = memoryview(self.reg)
+        # Flags: one packed byte, 00000LGE
+        # if a particular bit is set, that flag is "true"
+        self.FL = 0
         # Program Counter: the index into memory of the currently-executing instruction
         self.pc = 0
         # Boolean to start/stop the program
         self.running = False
+        # Why the last run stopped
+        self.halt_reason = None
+        # Number of instructions executed so far
+        self.cycles = 0
+        # Output sink PRN and friends write to (see sinks.py)
+        self.output = sys.stdout
+        # Called with no arguments whenever all loaded code is replaced,
+        # so other engines can drop what they built from it
+        self.watchers = []
+        # Called with the address whenever a byte of memory is written,
+        # for the same reason
+        self.address_watchers = []
+        # Label addresses from the symbol table of a binary image
+        self.symbols = {}
+        # Cleared while an interrupt handler runs (until its IRET)
+        self.interrupts_enabled = True
+        # Devices run() polls between slices of instructions, such as
+        # the Timer below or the keyboard in keyboard.py. Each has a
+        # poll(cpu) method that returns the cycle count it next needs to
+        # be polled at, or None if it doesn't mind
+        self.devices = []
+        # Memory-mapped devices by address, as (device, start address)
+        # pairs (see map_device())
+        self.io = [None] * 256
+        # When set to a list, external events are logged to it as
+        # (cycle, kind, value) tuples (see replay.py)
+        self.event_log = None
+        # Decode cache: one (handler, operand_a, operand_b, next_pc)
+        # entry per address, filled the first time that address runs
+        self.decoded = [None] * 256
         # Branch table
         self.branchtable = {}
         # Instruction branches
+        self.branchtable[NOP] = self.NOP        # No operation
         self.branchtable[HLT] = self.HLT        # Halt
         self.branchtable[LDI] = self.LDI        # Set value of a reg to an int
+        self.branchtable[LD] = self.LD          # Load a reg from memory
+        self.branchtable[ST] = self.ST          # Store a reg in memory
         self.branchtable[PRN] = self.PRN        # Print
+        self.branchtable[PRA] = self.PRA        # Print alpha character
         self.branchtable[PUSH] = self.PUSH      # Push
         self.branchtable[POP] = self.POP        # Pop
         self.branchtable[CALL] = self.CALL      # Call
@@ -67,33 +266,52 @@ class CPU:
         self.branchtable[JMP] = self.JMP        # Jump
         self.branchtable[JEQ] = self.JEQ        # Jump - Equal
         self.branchtable[JNE] = self.JNE        # Jump - not equal
-        self.branchtable[ADD] = self.ADD        # Add
-        self.branchtable[SUB] = self.SUB        # Subtract
-        self.branchtable[MUL] = self.MUL        # Multiply
-        self.branchtable[DIV] = self.DIV        # Divide
-        self.branchtable[MOD] = self.MOD        # Modulus
-        self.branchtable[CMP] = self.CMP        # Compare
-        self.branchtable[AND] = self.AND        # Bitwise-AND
-        self.branchtable[NOT] = self.NOT        # Bitwise-NOT
-        self.branchtable[OR] = self.OR          # Bitwise-OR
-        self.branchtable[XOR] = self.XOR        # Bitwise-XOR
-        self.branchtable[SHL] = self.SHL        # Shift bits left
-        self.branchtable[SHR] = self.SHR        # Shift bits right
-
-    def load(self):
-        """Load a program into memory."""
-
-        address = 0
-
-        # If there are less than 2 arguments entered, return error
-        if len(sys.argv) != 2:
-            print("Usage: comp.py program_name")
-            sys.exit(1)
-        
-        # Otherwise, go on with the load method
+        self.branchtable[JGT] = self.JGT        # Jump - greater than
+        self.branchtable[JLT] = self.JLT        # Jump - less than
+        self.branchtable[JLE] = self.JLE        # Jump - less than or equal
+        self.branchtable[JGE] = self.JGE        # Jump - greater than or equal
+        self.branchtable[INT] = self.INT        # Issue an interrupt
+        self.branchtable[IRET] = self.IRET      # Return from an interrupt
+        # ALU branches, built from the ALU table
+        for ir in (ADD, SUB, MUL, DIV, MOD, INC, DEC, CMP, AND, NOT, OR, XOR,
+                   SHL, SHR):
+            self.branchtable[ir] = self.alu_handler(ir)
+
+    def reset(self):
+        """Return the CPU to its power on state."""
+        # RAM, R0-R6, PC and FL are cleared, R7 is set to the top of the stack
+        self.ram[:] = bytes(len(self.ram))
+        self.reg[:] = bytes(8)
+        self.reg[7] = 0xF4
+        self.FL = 0
+        self.pc = 0
+        self.running = False
+        self.halt_reason = None
+        self.cycles = 0
+        self.interrupts_enabled = True
+        self.symbols = {}
+        self.flush()
+
+    def load(self, filename):
+        """Load a program into memory from a .ls8 or .ls8b file."""
+        self.load_file(filename)
+
+    def load_file(self, path):
+        """
+        Load a program file into memory. Binary images are recognised by
+        their magic number, anything else is read as a text .ls8 program.
+        """
+
+        # Binary images are copied into memory in one read
+        if is_image(path):
+            self.load_image(path)
+            return
+
+        program = bytearray()
+
         try:
             # Open the file entered
-            with open(sys.argv[1]) as f:
+            with open(path) as f:
                 # Loop through the lines in the file
                 for line in f:
                     # Remove all white space
@@ -113,96 +331,145 @@ class CPU:
                     # the unneccesary stuff is bypassed,
                     # continue with the load process
                     try:
-                        # Set the address of the ram to be
-                        # JUST the binary part of the file
-                        self.ram[address] = int(temp[0], 2)
+                        # Keep JUST the binary part of the line
+                        program.append(int(temp[0], 2))
 
                     # Set an error to catch invalid numbers
                     except ValueError:
-                        print(f"Invalid number: {temp[0]}")
-                        sys.exit(1)
+                        raise LoadError(f"Invalid number: {temp[0]}", 1)
+
+        # Set an error to catch invalid file
+        except FileNotFoundError:
+            raise LoadError(f"Couldn't open {path}", 2)
+
+        # If nothing was loaded, return error
+        if len(program) == 0:
+            raise LoadError("Program was empty!", 3)
 
-                    # Increment the address by 1
-                    address += 1
+        self.load_bytes(program)
+
+    def load_bytes(self, buf, addr=0):
+        """Copy a program (any bytes-like object) into memory at addr."""
+
+        if addr + len(buf) > len(self.ram):
+            raise LoadError(f"Program doesn't fit in memory at address {addr:02X}", 4)
+
+        self.ram[addr:addr + len(buf)] = buf
+        # A new program hasn't halted yet
+        self.halt_reason = None
+        # Forget anything decoded from a previous program
+        self.flush()
+
+    def load_image(self, filename):
+        """
+        Load a binary program image. The program bytes are read straight
+        into RAM at the image's load address, and the PC is set to its
+        entry point.
+        """
+
+        try:
+            with open(filename, "rb") as f:
+                header = f.read(IMAGE_HEADER.size)
+
+                # Make sure this is an image we understand
+                if len(header) != IMAGE_HEADER.size:
+                    raise LoadError(f"Truncated image: {filename}", 4)
+
+                magic, version, address, entry, length, symbol_count = \
+                    IMAGE_HEADER.unpack(header)
+
+                if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+                    raise LoadError(f"Not an LS-8 image: {filename}", 4)
+
+                if address + length > len(self.ram):
+                    raise LoadError(f"Image doesn't fit in memory: {filename}", 4)
+
+                # Copy the program bytes directly into RAM
+                if f.readinto(self.ram_view[address:address + length]) != length:
+                    raise LoadError(f"Truncated image: {filename}", 4)
+
+                # Read the symbol table
+                self.symbols = {}
+                for _ in range(symbol_count):
+                    symbol = f.read(2)
+                    if len(symbol) != 2:
+                        raise LoadError(f"Truncated image: {filename}", 4)
+                    symbol_address, name_length = symbol
+                    name = f.read(name_length)
+                    if len(name) != name_length:
+                        raise LoadError(f"Truncated image: {filename}", 4)
+                    self.symbols[name.decode("ascii")] = symbol_address
 
         # Set an error to catch invalid file
         except FileNotFoundError:
-            print(f"Couldn't open {sys.argv[1]}")
-            sys.exit(2)
+            raise LoadError(f"Couldn't open {filename}", 2)
+
+        except UnicodeDecodeError:
+            raise LoadError(f"Bad symbol name in image: {filename}", 4)
 
-        # If the address is zero, return error and exit
-        if address == 0:
-            print("Program was empty!")
-            sys.exit(3)
+        # If the image has no code, return error
+        if length == 0:
+            raise LoadError("Program was empty!", 3)
 
+        # A new program hasn't halted yet
+        self.halt_reason = None
+        # Forget anything decoded from a previous program
+        self.flush()
+        # Start running at the entry point
+        self.pc = entry
 
     def alu(self, op, reg_a, reg_b):
         """ALU operations."""
+        # op is the opcode byte; run the handler built for it
+        if op not in self.branchtable or not op & 0b00100000:
+            raise Exception("Unsupported ALU operation")
+        self.branchtable[op](reg_a, reg_b)
+
+    def alu_handler(self, op):
+        """
+        Build the branchtable handler for an ALU opcode from the ALU table.
+        This is the one place where results are wrapped to 8 bits.
+        """
+        name, function, expression = ALU_OPS[op & 0x0F]
+        reg = self.reg
 
-        # Add the value in two registers and
-        # store the result in registerA.
-        if op == "ADD":
-            self.reg[reg_a] += self.reg[reg_b]
-        # Subtract the value in the second register from the first,
-        # storing the result in registerA.
-        elif op == "SUB":
-            self.reg[reg_a] -= self.reg[reg_b]
-        # Multiply the values in two registers together and
-        # store the result in registerA.
-        elif op == "MUL":
-            self.reg[reg_a] *= self.reg[reg_b]
-        # Divide the value in the first register by the value in the second,
-        # storing the result in registerA.
-        elif op == "DIV":
-            self.reg[reg_a] /= self.reg[reg_b]
-        # Divide the value in the first register by the value in the second,
-        # storing the remainder of the result in registerA.
-        elif op == "MOD":
-            # If the value in the second register is 0...
-            if reg_b == 0:
-                # Print an error message and halt.
-                print("Second value can not be 0")
-                sys.exit()
-            # Otherwise, do the modulus operation
-            else:
-                self.reg[reg_a] %= self.reg[reg_b]
         # Compare the values in two registers
         #   Sets the flag bits: 00000LGE
         #                            <>=
-        elif op == "CMP":
-            # If equal, set E to 1 (true)
-            if self.reg[reg_a] == self.reg[reg_b]:
-                self.FL[-1] = 1
-            # If a > b, set G to 1 (true)
-            elif self.reg[reg_a] > self.reg[reg_b]:
-                self.FL[-2] = 1
-            # If a < b, set L to 1 (true)
-            elif self.reg[reg_a] < self.reg[reg_b]:
-                self.FL[-3] = 1
-        # Bitwise-AND the values in registerA and registerB, then store the result in registerA.
-        elif op == "AND":
-            self.reg[reg_a] &= self.reg[reg_b]
-        # Perform a bitwise-NOT on the value in a register, storing the result in the register.
-        elif op == "NOT":
-            self.reg[reg_a] = ~(self.reg[reg_a])
-        # Perform a bitwise-OR between the values in registerA and registerB, storing the result in registerA.
-        elif op == "OR":
-            self.reg[reg_a] |= self.reg[reg_b]
-        # Perform a bitwise-XOR between the values in registerA and registerB, storing the result in registerA.
-        #   Bitwise XOR sets the bits in the result to 1 if either, but not both,
-        #   of the corresponding bits in the two operands is 1.
-        elif op == "XOR":
-            self.reg[reg_a] ^= self.reg[reg_b]
-        # Shift the value in registerA left by the number of bits specified in registerB
-        # filling the low bits with 0
-        elif op == "SHL":
-            self.reg[reg_a] = (self.reg[reg_a] << self.reg[reg_b])
-        # Shift the value in registerA right by the number of bits specified in registerB
-        # filling the high bits with 0.
-        elif op == "SHR":
-            self.reg[reg_a] = (self.reg[reg_a] >> self.reg[reg_b])
-        else:
-            raise Exception("Unsupported ALU operation")
+        if name == "CMP":
+            def handler(reg_a, reg_b):
+                self.FL = function(reg[reg_a], reg[reg_b])
+            return handler
+
+        # INC and DEC run most loop counters, so they get handlers of
+        # their own instead of calling through the ALU table
+        if name == "INC":
+            def handler(reg_a, operand_b):
+                reg[reg_a] = (reg[reg_a] + 1) & 0xFF
+            return handler
+
+        if name == "DEC":
+            def handler(reg_a, operand_b):
+                reg[reg_a] = (reg[reg_a] - 1) & 0xFF
+            return handler
+
+        # One-operand instructions (NOT) only read registerA; the byte after
+        # it is the next instruction, not a register number
+        if op >> 6 == 1:
+            def handler(reg_a, operand_b):
+                reg[reg_a] = function(reg[reg_a], 0) & 0xFF
+            return handler
+
+        # Everything else stores its result in registerA
+        def handler(reg_a, reg_b):
+            try:
+                reg[reg_a] = function(reg[reg_a], reg[reg_b]) & 0xFF
+            # DIV and MOD by a zero register print an error and halt
+            except ZeroDivisionError:
+                print("Second value can not be 0", file=sys.stderr)
+                self.running = False
+                self.halt_reason = DIVIDE_BY_ZERO
+        return handler
 
     def trace(self):
         """
@@ -224,289 +491,582 @@ class CPU:
 
         print()
 
+    def stateful_devices(self):
+        """
+        The attached devices that have state of their own to snapshot,
+        mapped ones first, each once.
+        """
+        found = []
+        mapped = [mapping[0] for mapping in self.io if mapping is not None]
+        for device in mapped + self.devices:
+            if hasattr(device, "snapshot") and all(d is not device for d in found):
+                found.append(device)
+        return found
+
+    def snapshot(self):
+        """
+        Return the machine state (RAM, registers, PC, FL, cycle count and
+        whether it has halted, plus the state of devices that keep their
+        own) as a compact bytes blob for restore().
+        Text the program printed is flushed to the output sink first, so
+        the snapshot never holds output that was already produced.
+        """
+        self.output.flush()
+
+        state = 0
+        if self.halt_reason == HALTED:
+            state |= SNAPSHOT_HALTED
+        if not self.interrupts_enabled:
+            state |= SNAPSHOT_IN_INTERRUPT
+
+        parts = [
+            SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                 self.pc, self.FL, state, self.cycles),
+            self.reg,
+            self.ram,
+        ]
+
+        for device in self.stateful_devices():
+            data = device.snapshot()
+            parts.append(SNAPSHOT_DEVICE.pack(len(data)))
+            parts.append(data)
+
+        return b"".join(parts)
+
+    def restore(self, blob):
+        """
+        Put the machine back in the state a snapshot() blob recorded. The
+        same stateful devices have to be attached as when it was taken.
+        """
+        end = SNAPSHOT_HEADER.size + len(self.reg) + len(self.ram)
+        if len(blob) < end:
+            raise LoadError("Snapshot has the wrong size", 4)
+
+        magic, version, pc, fl, state, cycles = SNAPSHOT_HEADER.unpack_from(blob)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise LoadError("Not an LS-8 snapshot", 4)
+
+        view = memoryview(blob)
+
+        # Split off the device states before changing anything
+        sections = []
+        pos = end
+        while pos < len(blob):
+            if pos + SNAPSHOT_DEVICE.size > len(blob):
+                raise LoadError("Snapshot has the wrong size", 4)
+            (length,) = SNAPSHOT_DEVICE.unpack_from(blob, pos)
+            pos += SNAPSHOT_DEVICE.size + length
+            if pos > len(blob):
+                raise LoadError("Snapshot has the wrong size", 4)
+            sections.append(view[pos - length:pos])
+
+        devices = self.stateful_devices()
+        if len(sections) != len(devices):
+            raise LoadError("Snapshot doesn't match the attached devices", 4)
+
+        for device, data in zip(devices, sections):
+            try:
+                device.restore(data)
+            except ValueError as e:
+                raise LoadError(str(e), 4) from None
+
+        start = SNAPSHOT_HEADER.size
+        # Copy into the existing arrays, so views of them stay valid
+        self.reg[:] = view[start:start + len(self.reg)]
+        self.ram[:] = view[start + len(self.reg):end]
+        self.pc = pc
+        self.FL = fl
+        self.cycles = cycles
+        self.running = False
+        self.halt_reason = HALTED if state & SNAPSHOT_HALTED else None
+        self.interrupts_enabled = not state & SNAPSHOT_IN_INTERRUPT
+        # The code in memory may be completely different now
+        self.flush()
+
+    def fork(self):
+        """
+        Return an independent copy of this machine, ready to carry on from
+        exactly where this one stopped. It shares this one's output sink
+        and symbols but nothing it can modify, and gets a copy of its event
+        log if it keeps one. Machines with devices can't be forked: those
+        hold files, threads and terminals that a copy couldn't have to
+        itself.
+        """
+        if self.devices or any(self.io):
+            raise LS8Error("Can't fork a machine with devices attached")
+
+        other = CPU()
+        other.restore(self.snapshot())
+        other.output = self.output
+        other.symbols = self.symbols
+        if self.event_log is not None:
+            other.event_log = list(self.event_log)
+        return other
+
+    # Another name for fork()
+    clone = fork
+
     """
     ---------- Ram functions ----------
     """
     def ram_read(self, MAR):
         # Address = MAR = Memory Address Register:
             # holds the memory address we're reading or writing
-        # This returns the register at the parameter address
-        return self.reg[MAR]
+        # This returns the value in memory at the parameter address
+        return self.ram[MAR]
 
     def ram_write(self, MDR, MAR):
         # Value = MDR = Memory Data Register:
             # holds the value to write or the value just read
         # This sets the parameter value (MDR) at the parameter address in memory (MAR)
-        self.reg[MAR] = MDR
+        self.ram[MAR] = MDR
+        # The write may have changed an instruction we already decoded
+        self.invalidate(MAR)
+
+    """
+    ---------- Memory-mapped I/O ----------
+    """
+    def map_device(self, device, start, length):
+        """
+        Map length bytes of the address space, from start, to a device. The
+        device needs read(cpu, offset) and write(cpu, offset, value)
+        methods, offset counting from start (see devices.py).
+
+        RAM stays behind mapped addresses: writes land in it and are then
+        passed on to the device. Data reads through ram_read() ask the
+        device, while instruction fetch and POP/RET read RAM directly.
+        """
+        for address in range(start, start + length):
+            self.io[address & 0xFF] = (device, start)
+
+        # Until something is mapped, ram_read and ram_write are the plain
+        # methods above, so unmapped programs pay nothing for the bus
+        self.ram_read = self.bus_read
+        self.ram_write = self.bus_write
+        # Engines with their own write paths pick up the new map
+        self.flush()
+
+    def bus_read(self, MAR):
+        """ram_read() once devices are mapped."""
+        mapping = self.io[MAR]
+        if mapping is None:
+            return self.ram[MAR]
+        device, start = mapping
+        return device.read(self, MAR - start)
+
+    def bus_write(self, MDR, MAR):
+        """ram_write() once devices are mapped."""
+        self.ram[MAR] = MDR
+        self.invalidate(MAR)
+        mapping = self.io[MAR]
+        if mapping is not None:
+            device, start = mapping
+            device.write(self, MAR - start, MDR)
+
+    """
+    ---------- External events ----------
+    """
+    # Devices outside the CPU reach it through these, which is what lets
+    # replay.py record them and play them back at the same cycles
+
+    def interrupt(self, number):
+        """Raise an interrupt by setting its bit in IS."""
+        if self.event_log is not None:
+            self.event_log.append((self.cycles, "interrupt", number))
+        self.reg[IS] |= 1 << number
+
+    def key_press(self, key):
+        """Store a key at KEY_ADDRESS and raise the keyboard interrupt."""
+        if self.event_log is not None:
+            self.event_log.append((self.cycles, "key", key))
+        self.ram_write(key, KEY_ADDRESS)
+        self.reg[IS] |= 1 << KEYBOARD_INTERRUPT
+
+    def serve_interrupt(self):
+        """
+        Start the handler for the lowest-numbered interrupt that is pending
+        in IS and enabled in IM. The engines only call this when
+        IM & IS is non-zero and interrupts are enabled.
+        """
+        masked = self.reg[IM] & self.reg[IS]
+        # Isolate the lowest set bit instead of looping over all 8
+        bit = masked & -masked
+
+        # Disable further interrupts and clear this one's bit in IS
+        self.interrupts_enabled = False
+        self.reg[IS] &= ~bit & 0xFF
+
+        # Save the PC, FL and R0-R6 on the stack
+        self.push(self.pc)
+        self.push(self.FL)
+        for n in range(7):
+            self.push(self.reg[n])
+
+        # Jump to the handler from the vector table
+        self.pc = self.ram[VECTOR_TABLE + bit.bit_length() - 1]
+
+    """
+    ---------- Stack functions ----------
+    """
+    def push(self, value):
+        """Push a value on the stack."""
+        self.reg[7] = (self.reg[7] - 1) & 0xFF
+        self.ram_write(value, self.reg[7])
+
+    def pop(self):
+        """Pop a value off the stack."""
+        value = self.ram[self.reg[7]]
+        self.reg[7] = (self.reg[7] + 1) & 0xFF
+        return value
+
+    """
+    ---------- Decode cache ----------
+    """
+    def decode(self, address):
+        """
+        Decode the instruction at the given address into a ready-to-run
+        (handler, operand_a, operand_b, next_pc) entry and cache it.
+        """
+        # Fetch the instruction and both possible operand bytes
+        ir = self.ram[address]
+        operand_a = self.ram[(address + 1) & 0xFF]
+        operand_b = self.ram[(address + 2) & 0xFF]
+        # The AA bits hold the operand count, so the instruction is
+        # that many bytes long plus one for the opcode itself
+        next_pc = (address + (ir >> 6) + 1) & 0xFF
+        # Find the ir method in the branchtable
+        try:
+            entry = (self.branchtable[ir], operand_a, operand_b, next_pc)
+        except KeyError:
+            raise InvalidInstruction(ir, address) from None
+        # Register operands have to name R0-R7 (LDI's second operand is an
+        # immediate, so only check the first)
+        if ir >> 6 >= 1 and operand_a > 7:
+            raise InvalidInstruction(ir, address, operand_a)
+        if ir >> 6 == 2 and ir != LDI and operand_b > 7:
+            raise InvalidInstruction(ir, address, operand_b)
+        # Remember it so the next pass over this address skips decoding
+        self.decoded[address] = entry
+        return entry
+
+    def flush(self):
+        """Drop every decoded instruction, e.g. after loading new code."""
+        self.decoded[:] = [None] * 256
+        for watcher in self.watchers:
+            watcher()
+
+    def invalidate(self, address):
+        """Drop every cached instruction that could cover this address."""
+        # An instruction is at most 3 bytes long, so it can only start at
+        # the written address or one of the two bytes before it
+        # (negative indexes wrap around to the top of memory)
+        self.decoded[address] = None
+        self.decoded[address - 1] = None
+        self.decoded[address - 2] = None
+        for watcher in self.address_watchers:
+            watcher(address)
 
     """
     ---------- Instruction functions ----------
     """
+    # The run loop has already moved the PC past the instruction by the time
+    # a handler is called, so only the PC mutators need to touch it
+
+    # Do nothing
+    def NOP(self, operand_a, operand_b):
+        pass
+
     # Halt the CPU (and exit the emulator)
-    def HLT(self):
+    def HLT(self, operand_a, operand_b):
         self.running = False
+        self.halt_reason = HALTED
 
     # Set the value of a register to an integer
-    def LDI(self):
-        # Set and store the address (+1 bit) and value (+1 bit) in ram
-        address = self.ram[self.pc + 1]
-        value = self.ram[self.pc + 2]
-        # Run the ram_write helper function with the current
-        # address/value as parameters
-        self.ram_write(value, address)
-        # Increment the pc by 3
-        # because this is a 3-bit operation
-        self.pc += 3
+    def LDI(self, address, value):
+        # Store the decoded value in the decoded register
+        self.reg[address] = value
+
+    # Load registerA with the value at the memory address stored in registerB
+    def LD(self, reg_a, reg_b):
+        # Through ram_read, so memory-mapped devices see the read
+        self.reg[reg_a] = self.ram_read(self.reg[reg_b])
+
+    # Store the value in registerB at the memory address stored in registerA
+    def ST(self, reg_a, reg_b):
+        self.ram_write(self.reg[reg_b], self.reg[reg_a])
 
     # Print to the console the decimal integer value
     # that is stored in the given register.
-    def PRN(self):
-        # Set the address stored in ram (1 bit)
-        address = self.ram[self.pc + 1]
-        # Run the ram_read helper function with
-        # the current address and print it
-        print(self.ram_read(address))
-        # Increment the pc by 2 (2-bit operation)
-        self.pc += 2
-
-    def PUSH(self):
+    def PRN(self, address, operand_b):
+        # Print the value stored in the decoded register
+        self.output.write(f"{self.reg[address]}\n")
+
+    # Print to the console the ASCII character for the value in the register
+    def PRA(self, address, operand_b):
+        self.output.write(chr(self.reg[address]))
+
+    def PUSH(self, reg_num, operand_b):
         # Decrement the stack pointer
-        self.reg[7] -= 1
-        # Get value from register
-        reg_num = self.ram[self.pc + 1]
+        self.reg[7] = (self.reg[7] - 1) & 0xFF
         # Value to push
         value = self.reg[reg_num]
         # Store it on the stack
         top_of_stack_address = self.reg[7]
         # Push the value from the register to the RAM
-        self.ram[top_of_stack_address] = value
-        # Increment the pc by 2 (2-bit operation)
-        self.pc += 2
+        self.ram_write(value, top_of_stack_address)
 
-    def POP(self):
+    def POP(self, reg_num, operand_b):
         # Point at the top of the stack
         top_of_stack_address = self.reg[7]
         # Value to pop
         value = self.ram[top_of_stack_address]
-        # Get value from register
-        reg_num = self.ram[self.pc + 1]
         # Overwrite the register number's value to the popped value
         self.reg[reg_num] = value
         # Increment the stack pointer
-        self.reg[7] += 1
-        # Increment the pc by 2 (2-bit operation)
-        self.pc += 2
-
-    """
-    ---------- ALU functions ----------
-    """
-    # Add the value in two registers and
-    # store the result in registerA.
-    def ADD(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("ADD", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Subtract the value in the second register from the first,
-    # storing the result in registerA.
-    def SUB(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("SUB", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Multiply the values in two registers together and
-    # store the result in registerA.
-    def MUL(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("MUL", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Divide the value in the first register by the value in the second,
-    # storing the result in registerA.
-    def DIV(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("DIV", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Divide the value in the first register by the value in the second,
-    # storing the remainder of the result in registerA.
-    def MOD(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("MOD", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Compare the values in two registers
-    def CMP(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("CMP", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Bitwise-AND the values in registerA and registerB, then store the result in registerA.
-    def AND(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("AND", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Perform a bitwise-NOT on the value in a register, storing the result in the register.
-    def NOT(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("NOT", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Perform a bitwise-OR between the values in registerA and registerB, storing the result in registerA.
-    def OR(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("OR", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Perform a bitwise-XOR between the values in registerA and registerB, storing the result in registerA.
-    #   Bitwise XOR sets the bits in the result to 1 if either, but not both,
-    #   of the corresponding bits in the two operands is 1.
-    def XOR(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("XOR", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Shift the value in registerA left by the number of bits specified in registerB
-    # filling the low bits with 0
-    def SHL(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("SHL", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
-
-    # Shift the value in registerA right by the number of bits specified in registerB
-    # filling the high bits with 0.
-    def SHR(self):
-        # Set and store the first and second parameter values in ram
-        reg_a = self.ram[self.pc + 1]
-        reg_b = self.ram[self.pc + 2]
-        # Call the ALU method and pass it the operation and values
-        self.alu("SHR", reg_a, reg_b)
-        # Increment the pc by 3 (3-bit operation)
-        self.pc += 3
+        self.reg[7] = (self.reg[7] + 1) & 0xFF
 
     """
     ---------- PC mutator functions ----------
     """
     # Calls a subroutine (function) at the address stored in the register
-    def CALL(self):
-        # Push return address
-        ret_address = self.pc + 2
+    def CALL(self, regnum, operand_b):
+        # Push return address (the PC already points past the CALL)
+        ret_address = self.pc
         # Decrement the stack pointer
-        self.reg[7] -= 1
-        self.ram[self.reg[7]] = ret_address
+        self.reg[7] = (self.reg[7] - 1) & 0xFF
+        self.ram_write(ret_address, self.reg[7])
         # Set the PC to the address stored in the given register
-        regnum = self.ram[self.pc + 1]
         subroutine_address = self.reg[regnum]
         self.pc = subroutine_address
 
     # Pop the value from the top of the stack and store it in the PC
-    def RET(self):
+    def RET(self, operand_a, operand_b):
         # Pop the return addr off the stack
         ret_address = self.ram[self.reg[7]]
-        self.reg[7] += 1
+        self.reg[7] = (self.reg[7] + 1) & 0xFF
         # Set the PC to it
         self.pc = ret_address
 
     # Set the PC to the address stored in the given register
-    def JMP(self):
-        # Grab the address from memory
-        memory_address = self.ram[self.pc + 1]
+    def JMP(self, memory_address, operand_b):
         # Set the PC to it
         self.pc = self.reg[memory_address]
 
     # If equal flag is set (true), jump to the address stored in the given register
-    def JEQ(self):
+    def JEQ(self, address, operand_b):
         # If the E flag is marked 1 (true)
-        if self.FL[-1] == 1:
-            # Set the address to jump to
-            address = self.ram[self.pc + 1]
-            # Set the new address
-            new_address = self.reg[address]
-            # Set the PC to the new address
-            self.pc = new_address
-        # If it's set to false, continue by only incrementing the PC counter
-        # (because this operation was still run)
-        else:
-            # 2 bits!
-            self.pc += 2
+        if self.FL & 1:
+            # Set the PC to the address in the decoded register
+            self.pc = self.reg[address]
+        # If it's set to false, the PC already points at the next instruction
 
     # If E flag is clear (false, 0), jump to the address stored in the given register.
-    def JNE(self):
+    def JNE(self, address, operand_b):
         # If the E flag is marked 0 (false)
-        if self.FL[-1] == 0:
-            # Set the address to jump to
-            address = self.ram[self.pc + 1]
-            # Set the new address
-            new_address = self.reg[address]
-            # Set the PC to the new address
-            self.pc = new_address
-        # If it's set to false, continue by only incrementing the PC counter
-        # (because this operation was still run)
-        else:
-            # 2 bits!
-            self.pc += 2
+        if not self.FL & 1:
+            # Set the PC to the address in the decoded register
+            self.pc = self.reg[address]
+        # If it's set to true, the PC already points at the next instruction
+
+    # The rest of the conditional jumps test the L and G flags as well
+    def JGT(self, address, operand_b):
+        if self.FL & 0b010:
+            self.pc = self.reg[address]
+
+    def JLT(self, address, operand_b):
+        if self.FL & 0b100:
+            self.pc = self.reg[address]
+
+    def JLE(self, address, operand_b):
+        if self.FL & 0b101:
+            self.pc = self.reg[address]
+
+    def JGE(self, address, operand_b):
+        if self.FL & 0b011:
+            self.pc = self.reg[address]
 
+    # Set the nth bit of IS, n being the value in the given register
+    def INT(self, reg_num, operand_b):
+        self.reg[IS] |= 1 << (self.reg[reg_num] & 7)
 
+    # Return from an interrupt handler
+    def IRET(self, operand_a, operand_b):
+        # Restore R6-R0, FL and the PC saved when the interrupt was served
+        for n in range(6, -1, -1):
+            self.reg[n] = self.pop()
+        self.FL = self.pop()
+        self.pc = self.pop()
+        # Interrupts are re-enabled
+        self.interrupts_enabled = True
 
     """
     ---------- Run the CPU ----------
     """
-    def run(self):
+    def run(self, max_cycles=None, capture=False, engine=None, timeout=None):
+        """
+        Run the program until it halts, until it has executed max_cycles
+        more instructions, or until timeout seconds have passed. A run
+        stopped by either limit keeps its state and can be resumed by
+        calling run() again, so a scheduler can use this to time-slice many
+        CPUs. With capture set, the program's output is returned in the
+        result instead of being printed. A program that has already halted
+        doesn't run again: the result says so, with no cycles.
+        """
+        # Don't run on into whatever follows the HLT
+        if self.halt_reason == HALTED:
+            return RunResult(HALTED, 0, "" if capture else None)
+
+        if capture:
+            output = self.output
+            self.output = ListSink()
+
+        start = self.cycles
+        limit = None if max_cycles is None else start + max_cycles
+        text = None
+
+        # Execute with the interpreter unless another engine is given
+        execute = engine or self.execute
+
+        try:
+            if timeout is None and not self.devices:
+                execute(limit)
+            else:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                self.execute_until(execute, limit, deadline)
+        finally:
+            # Never hold buffered output past the end of a run
+            self.output.flush()
+            if capture:
+                text = self.output.getvalue()
+                self.output = output
+
+        return RunResult(self.halt_reason, self.cycles - start, text)
+
+    def execute_until(self, execute, limit, deadline):
+        """
+        Execute in slices of TIME_SLICE instructions, so the clock and the
+        devices are read between slices instead of on every instruction.
+        deadline may be None for no deadline.
+        """
+        devices = self.devices
+
+        while True:
+            slice_limit = self.cycles + TIME_SLICE
+            for device in devices:
+                # Let it raise its interrupts, and end the slice early if
+                # it has to be polled again sooner
+                due = device.poll(self)
+                if due is not None and due < slice_limit:
+                    slice_limit = due
+            if limit is not None and slice_limit > limit:
+                slice_limit = limit
+
+            execute(slice_limit)
+
+            # Halted, or the caller's own cycle budget is spent
+            if self.halt_reason != CYCLE_LIMIT:
+                return
+            if limit is not None and self.cycles >= limit:
+                return
+
+            if deadline is not None and time.monotonic() >= deadline:
+                self.halt_reason = DEADLINE
+                return
+
+            # Long-running programs are often interactive, so don't hold
+            # their output for longer than a slice
+            self.output.flush()
+
+    def execute(self, limit=None):
+        """Interpret instructions until the CPU halts or cycles reaches limit."""
         # Start the program
         self.running = True
+        self.halt_reason = None
 
-        while self.running:
-            # Read the memory address that's stored in the register's PC
-            # And store the result in the Instruction Register (ir)
-            ir = self.ram[self.pc]
+        # Local aliases for the hot loop
+        reg = self.reg
+        decoded = self.decoded
+        decode = self.decode
+        # Count instructions in a local, and store the count even if
+        # an instruction fails
+        cycles = self.cycles
+        # No program runs for sys.maxsize cycles, so that means no limit
+        if limit is None:
+            limit = sys.maxsize
 
-            if ir and 0b00010000 == 0:
-                self.pc += (ir >> 6) + 1
-            else:
-                # Find the ir method in the branchtable and execute it
-                self.branchtable[ir]()
\ No newline at end of file
+        try:
+            while self.running:
+                # Stop (resumably) once the cycle budget is spent, even
+                # if it was already spent before we started
+                if cycles >= limit:
+                    self.running = False
+                    self.halt_reason = CYCLE_LIMIT
+                    break
+
+                # One masked test for interrupts: IM & IS is only non-zero
+                # when an interrupt is both pending and enabled
+                if reg[5] & reg[6] and self.interrupts_enabled:
+                    self.serve_interrupt()
+
+                # Look up the decoded instruction at the PC,
+                # decoding it on the first visit
+                entry = decoded[self.pc]
+                if entry is None:
+                    entry = decode(self.pc)
+
+                handler, operand_a, operand_b, self.pc = entry
+                # Execute it with the operands that were decoded for it
+                handler(operand_a, operand_b)
+                cycles += 1
+        finally:
+            self.cycles = cycles
+
+
+class Timer:
+    """
+    Raises the timer interrupt (I0) at a fixed rate. By default it follows
+    the wall clock, once every TIMER_SECONDS. Given a number of cycles it
+    runs on virtual time instead, ticking every that many instructions,
+    which is reproducible and never waits on a real clock. Add it to
+    cpu.devices.
+    """
+
+    def __init__(self, seconds=TIMER_SECONDS, cycles=None):
+        self.seconds = seconds
+        self.cycles = cycles
+        # When the next tick is due: a cycle count in virtual time,
+        # a time.monotonic() reading otherwise
+        self.next_tick = None
+
+    def poll(self, cpu):
+        """
+        Raise I0 if a tick is due. Returns the cycle count the next virtual
+        tick falls on, or None on wall-clock time.
+        """
+        if self.cycles is None:
+            now = time.monotonic()
+            if self.next_tick is None:
+                self.next_tick = now + self.seconds
+            elif now >= self.next_tick:
+                cpu.interrupt(TIMER_INTERRUPT)
+                # Ticks missed while the CPU wasn't running are dropped
+                while self.next_tick <= now:
+                    self.next_tick += self.seconds
+            return None
+
+        if self.next_tick is None:
+            self.next_tick = cpu.cycles + self.cycles
+        elif cpu.cycles >= self.next_tick:
+            cpu.interrupt(TIMER_INTERRUPT)
+            self.next_tick += self.cycles
+        return self.next_tick
+
+
+def is_image(filename):
+    """Check whether a file starts with the binary image magic number."""
+    try:
+        with open(filename, "rb") as f:
+            return f.read(len(IMAGE_MAGIC)) == IMAGE_MAGIC
+    # Let the loader report files it can't open
+    except OSError:
+        return False
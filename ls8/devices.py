@@ -0,0 +1,202 @@
+"""Devices for the memory-mapped I/O bus."""
+
+import mmap
+import os
+import struct
+
+"""
+A device has read(cpu, offset) and write(cpu, offset, value), offset
+counting from the address it was mapped at with CPU.map_device(). Writes
+have already landed in RAM when write() is called, so a device that only
+cares about writes can return cpu.ram[...] from read().
+
+    cpu.map_device(Console(), CONSOLE_ADDRESS, Console.size)
+"""
+
+# Default console address, a reserved byte between the key and the
+# interrupt vectors. Block devices are mapped wherever the program keeps
+# them free, since no reserved range is big enough.
+CONSOLE_ADDRESS = 0xF5
+
+# Where BankedMemory shows its current bank by default, and the two
+# reserved bytes holding the bank number (low byte first)
+BANK_WINDOW = 0x80
+BANK_WINDOW_SIZE = 0x40
+BANK_REGISTER = 0xF6
+
+# How BankedMemory's snapshot starts: the selected bank
+BANK_STATE = struct.Struct("<H")
+
+# Bytes a BlockDevice moves per command
+BLOCK_SIZE = 16
+
+# BlockDevice registers, as offsets from where it is mapped
+BLOCK_NUMBER = 0    # Which block of the file to use
+BLOCK_BUFFER = 1    # RAM address of the block buffer
+BLOCK_COMMAND = 2   # Write a command here to start a transfer
+BLOCK_STATUS = 3    # Result of the last command
+
+# BlockDevice commands and status values
+BLOCK_READ = 1      # Copy the block into the buffer
+BLOCK_WRITE = 2     # Copy the buffer into the block
+BLOCK_OK = 0
+BLOCK_ERROR = 0xFF  # Unknown command, or a read past the end of the file
+
+
+class Console:
+    """One byte: every value written to it is printed as a character."""
+
+    size = 1
+
+    def read(self, cpu, offset):
+        return 0
+
+    def write(self, cpu, offset, value):
+        cpu.output.write(chr(value))
+
+
+class BlockDevice:
+    """
+    A file, read and written BLOCK_SIZE bytes at a time. Set the block
+    number and the buffer address, then write BLOCK_READ or BLOCK_WRITE to
+    the command register; the transfer is done by the time the write
+    returns, and the status register says how it went.
+    """
+
+    size = 4
+
+    def __init__(self, path, block_size=BLOCK_SIZE):
+        # Create the file if it doesn't exist yet
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.block_size = block_size
+        self.registers = bytearray(self.size)
+
+    def read(self, cpu, offset):
+        return self.registers[offset]
+
+    def write(self, cpu, offset, value):
+        self.registers[offset] = value
+        if offset != BLOCK_COMMAND:
+            return
+
+        buffer = self.registers[BLOCK_BUFFER]
+        # The buffer can't run past the top of memory
+        length = min(self.block_size, len(cpu.ram) - buffer)
+        self.file.seek(self.registers[BLOCK_NUMBER] * self.block_size)
+
+        if value == BLOCK_READ:
+            data = self.file.read(length)
+            if not data:
+                self.registers[BLOCK_STATUS] = BLOCK_ERROR
+                return
+            # Short blocks at the end of the file are padded with zeros
+            cpu.ram_view[buffer:buffer + length] = data.ljust(length, b"\0")
+            # The buffer may have held code
+            cpu.flush()
+
+        elif value == BLOCK_WRITE:
+            self.file.write(cpu.ram_view[buffer:buffer + length])
+            self.file.flush()
+
+        else:
+            self.registers[BLOCK_STATUS] = BLOCK_ERROR
+            return
+
+        self.registers[BLOCK_STATUS] = BLOCK_OK
+
+    def close(self):
+        self.file.close()
+
+
+class BankedMemory:
+    """
+    Memory far bigger than the address space, seen one bank at a time
+    through a window of it. The program picks the bank by writing its
+    number to the two bank registers (low byte, then high byte); switching
+    only re-slices a memoryview, nothing is copied. Backed by a bytearray,
+    or by an mmap'd file with from_file(), so datasets can be streamed
+    through a program without loading them first.
+
+    Reads and writes of the window go through the bus, i.e. LD and ST.
+    Code can't run from the window: instruction fetch sees plain RAM.
+
+        banks = BankedMemory(1 << 20)
+        banks.attach(cpu)
+    """
+
+    def __init__(self, store, window_size=BANK_WINDOW_SIZE):
+        # A size in bytes, or an existing buffer to use as the banks
+        if isinstance(store, int):
+            store = bytearray(store)
+        self.store = store
+        self.banks = memoryview(store)
+        self.window_size = window_size
+        self.bank = 0
+        self.window = self.banks[:window_size]
+
+    @classmethod
+    def from_file(cls, path, window_size=BANK_WINDOW_SIZE):
+        """Banks backed by a file, changes written straight back to it."""
+        with open(path, "r+b") as f:
+            return cls(mmap.mmap(f.fileno(), 0), window_size)
+
+    def attach(self, cpu, window=BANK_WINDOW, register=BANK_REGISTER):
+        """Map the window and the bank registers into the CPU's memory."""
+        cpu.map_device(self, window, self.window_size)
+        cpu.map_device(BankRegister(self), register, BankRegister.size)
+
+    def select(self, bank):
+        """Show another bank in the window."""
+        start = bank * self.window_size
+        self.bank = bank
+        # A bank past the end of the store shows up as an empty window
+        self.window = self.banks[start:start + self.window_size]
+
+    def snapshot(self):
+        """The selected bank and every bank's contents, for CPU.snapshot()."""
+        return BANK_STATE.pack(self.bank) + bytes(self.store)
+
+    def restore(self, data):
+        """Go back to what snapshot() returned, for CPU.restore()."""
+        if len(data) != BANK_STATE.size + len(self.store):
+            raise ValueError("Banked memory snapshot has the wrong size")
+        (bank,) = BANK_STATE.unpack_from(data)
+        self.store[:] = data[BANK_STATE.size:]
+        self.select(bank)
+
+    def read(self, cpu, offset):
+        # The last bank of a file may be short
+        if offset < len(self.window):
+            return self.window[offset]
+        return 0
+
+    def write(self, cpu, offset, value):
+        if offset < len(self.window):
+            self.window[offset] = value
+
+    def close(self):
+        # Views of an mmap have to go before it can be closed
+        self.window.release()
+        self.banks.release()
+        if isinstance(self.store, mmap.mmap):
+            self.store.close()
+
+
+class BankRegister:
+    """The two bytes that select a BankedMemory's bank, low byte first."""
+
+    size = 2
+
+    def __init__(self, banked):
+        self.banked = banked
+
+    def read(self, cpu, offset):
+        return (self.banked.bank >> (8 * offset)) & 0xFF
+
+    def write(self, cpu, offset, value):
+        bank = self.banked.bank
+        if offset == 0:
+            bank = (bank & 0xFF00) | value
+        else:
+            bank = (bank & 0x00FF) | (value << 8)
+        self.banked.select(bank)
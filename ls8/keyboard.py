@@ -0,0 +1,81 @@
+"""Keyboard device: feeds keystrokes to the CPU between instruction slices."""
+
+import os
+import queue
+import sys
+import threading
+
+from cpu import *
+
+try:
+    import termios
+    import tty
+except ImportError:
+    # Not on a Unix terminal; keys arrive a line at a time instead
+    termios = None
+
+
+class Keyboard:
+    """
+    Reads keys on a background thread and queues them, so nothing in the
+    run loop ever waits on input. run() polls it between slices (add it to
+    cpu.devices); each poll hands the program at most one key, the way the
+    spec's keyboard does: stored at 0xF4, with I1 raised.
+
+    The input is stdin by default. A terminal is put in cbreak mode, so
+    keys arrive as they are pressed. A pipe or file works too, for scripted
+    input. Call close() when done to restore the terminal.
+    """
+
+    def __init__(self, stream=None):
+        # Keep the stream open for as long as the reader needs it
+        self.stream = sys.stdin if stream is None else stream
+        self.fd = self.stream.fileno()
+        # Keys read but not yet delivered, and None once the input ends
+        self.keys = queue.SimpleQueue()
+        self.finished = False
+
+        # Terminal settings to restore in close()
+        self.saved = None
+        if termios is not None and os.isatty(self.fd):
+            self.saved = termios.tcgetattr(self.fd)
+            tty.setcbreak(self.fd)
+
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.reader.start()
+
+    def read(self):
+        """Background thread: queue every byte of input as it arrives."""
+        try:
+            while True:
+                data = os.read(self.fd, 1024)
+                if not data:
+                    break
+                for key in data:
+                    self.keys.put(key)
+        except OSError:
+            pass
+        self.keys.put(None)
+
+    def poll(self, cpu):
+        """Deliver the next key, once the program has taken the last one."""
+        # A key whose interrupt is still pending hasn't been read yet
+        if self.finished or cpu.reg[IS] & (1 << KEYBOARD_INTERRUPT):
+            return None
+
+        try:
+            key = self.keys.get_nowait()
+        except queue.Empty:
+            return None
+
+        if key is None:
+            self.finished = True
+        else:
+            cpu.key_press(key)
+        return None
+
+    def close(self):
+        """Put the terminal back the way it was."""
+        if self.saved is not None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
+            self.saved = None
@@ -4,8 +4,58 @@
 
 import sys
 from cpu import *
+from keyboard import Keyboard
+from replay import record, save_events
+from sinks import BufferedSink
+
+USAGE = "Usage: ls8.py [--record events_file] program_name [input_file]"
+
+args = sys.argv[1:]
+
+# Optionally log every key and timer tick, for replay.py
+events_file = None
+if "--record" in args:
+    i = args.index("--record")
+    if i + 1 == len(args):
+        print(USAGE)
+        sys.exit(1)
+    events_file = args[i + 1]
+    del args[i:i + 2]
+
+# Expect a program, and optionally a file of scripted keyboard input
+if len(args) not in (1, 2):
+    print(USAGE)
+    sys.exit(1)
 
 cpu = CPU()
+# Buffer output, run() flushes it when the program stops
+cpu.output = BufferedSink(sys.stdout)
+# The timer interrupt fires once a second
+cpu.devices.append(Timer())
+
+try:
+    cpu.load(args[0])
+except LS8Error as e:
+    print(e)
+    sys.exit(e.exit_code)
+
+# Keys come from the input file if there is one, stdin otherwise
+try:
+    keyboard = Keyboard(open(args[1], "rb") if len(args) == 2 else None)
+except FileNotFoundError:
+    print(f"Couldn't open {args[1]}")
+    sys.exit(2)
+cpu.devices.append(keyboard)
+
+events = record(cpu) if events_file is not None else None
 
-cpu.load()
-cpu.run()
\ No newline at end of file
+try:
+    cpu.run()
+except LS8Error as e:
+    print(e)
+    sys.exit(e.exit_code)
+finally:
+    keyboard.close()
+    # Save the log however the run ended, Ctrl-C included
+    if events is not None:
+        save_events(events, events_file, cpu.cycles)
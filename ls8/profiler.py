@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""Per-opcode profiler, hot-address heatmap and subroutine call profile."""
+
+import argparse
+import json
+import sys
+
+from cpu import *
+from sinks import BufferedSink
+
+# Where the stack pointer starts, see the spec's memory map
+STACK_TOP = 0xF4
+
+
+class Profiler:
+    """
+    Instrumented execution engine. Counts executions per opcode and per PC
+    address, cycles spent in each CALL'd subroutine and the stack
+    high-water mark. It only costs anything while it is the engine in use;
+    CPU.run on its own still uses the uninstrumented loop.
+    """
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # Executions per opcode and per address
+        self.opcodes = [0] * 256
+        self.addresses = [0] * 256
+        # Subroutine address -> [calls, cycles including callees]
+        self.subroutines = {}
+        # Folded call stack ("main;Sub1;Sub2") -> cycles spent in its top frame
+        self.folded = {}
+        # Open CALLs as (subroutine address, cycle count at entry)
+        self.frames = []
+        self.stack_key = "main"
+        # Cycle count when the current frame was last charged
+        self.mark = cpu.cycles
+        # Subroutine names by address
+        self.names = {}
+        # Lowest stack pointer seen
+        self.stack_low = cpu.reg[7]
+
+    def run(self, max_cycles=None, capture=False, timeout=None):
+        """Run the CPU's program with profiling. Same arguments as CPU.run()."""
+        return self.cpu.run(max_cycles, capture, self.execute, timeout)
+
+    def execute(self, limit=None):
+        """The interpreter loop from CPU.execute(), with counters added."""
+        cpu = self.cpu
+        # Start the program
+        cpu.running = True
+        cpu.halt_reason = None
+
+        # Local aliases for the loop
+        ram = cpu.ram
+        reg = cpu.reg
+        decoded = cpu.decoded
+        decode = cpu.decode
+        opcodes = self.opcodes
+        addresses = self.addresses
+        cycles = cpu.cycles
+        if limit is None:
+            limit = -1
+
+        try:
+            while cpu.running:
+                if cycles == limit:
+                    cpu.running = False
+                    cpu.halt_reason = CYCLE_LIMIT
+                    break
+
+                if reg[5] & reg[6] and cpu.interrupts_enabled:
+                    cpu.serve_interrupt()
+                    # Interrupt handlers are profiled like subroutines
+                    self.enter(cpu.pc, cycles)
+
+                pc = cpu.pc
+                entry = decoded[pc]
+                if entry is None:
+                    entry = decode(pc)
+
+                handler, operand_a, operand_b, cpu.pc = entry
+                ir = ram[pc]
+                opcodes[ir] += 1
+                addresses[pc] += 1
+
+                handler(operand_a, operand_b)
+                cycles += 1
+
+                if reg[7] < self.stack_low:
+                    self.stack_low = reg[7]
+
+                # CALL and RET (or IRET) open and close subroutine frames
+                if ir == CALL:
+                    self.enter(cpu.pc, cycles)
+                elif (ir == RET or ir == IRET) and self.frames:
+                    self.leave(cycles)
+        finally:
+            cpu.cycles = cycles
+            self.charge(cycles)
+
+    """
+    ---------- Call stack ----------
+    """
+    def name(self, address):
+        """Name a subroutine by its label if the image had one."""
+        if address not in self.names:
+            self.names[address] = f"sub_{address:02X}"
+            for label, symbol_address in self.cpu.symbols.items():
+                if symbol_address == address:
+                    self.names[address] = label
+                    break
+        return self.names[address]
+
+    def charge(self, cycles):
+        """Charge the cycles since the last mark to the current stack."""
+        if cycles > self.mark:
+            self.folded[self.stack_key] = \
+                self.folded.get(self.stack_key, 0) + cycles - self.mark
+        self.mark = cycles
+
+    def enter(self, address, cycles):
+        # The CALL itself belongs to the caller
+        self.charge(cycles)
+        self.frames.append((address, cycles))
+        self.stack_key += ";" + self.name(address)
+
+    def leave(self, cycles):
+        # The RET belongs to the subroutine
+        self.charge(cycles)
+        address, entered = self.frames.pop()
+
+        calls = self.subroutines.setdefault(address, [0, 0])
+        calls[0] += 1
+        calls[1] += cycles - entered
+
+        self.stack_key = self.stack_key.rsplit(";", 1)[0]
+
+    """
+    ---------- Export ----------
+    """
+    def stack_high_water(self):
+        """Most bytes the stack has held at once."""
+        return STACK_TOP - self.stack_low
+
+    def to_json(self):
+        """All counts as a JSON-ready dict."""
+        return {
+            "cycles": self.cpu.cycles,
+            "opcodes": {
+                OPCODE_NAMES.get(ir, f"{ir:08b}"): count
+                for ir, count in enumerate(self.opcodes) if count
+            },
+            "addresses": {
+                f"{address:02X}": count
+                for address, count in enumerate(self.addresses) if count
+            },
+            "subroutines": {
+                self.name(address): {"calls": calls, "cycles": cycles}
+                for address, (calls, cycles) in self.subroutines.items()
+            },
+            "stack_high_water": self.stack_high_water(),
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, indent=2)
+
+    def write_folded(self, path):
+        """
+        Write the call stacks in the folded format flamegraph tools read:
+        one "main;Sub1;Sub2 cycles" line per stack.
+        """
+        with open(path, "w") as f:
+            for stack, cycles in sorted(self.folded.items()):
+                f.write(f"{stack} {cycles}\n")
+
+    def report(self, top=10, file=sys.stderr):
+        """Print the hottest opcodes, addresses and subroutines."""
+        data = self.to_json()
+
+        print(f"{data['cycles']} cycles, stack high-water "
+              f"{data['stack_high_water']} bytes", file=file)
+
+        print("opcodes:", file=file)
+        for name, count in sorted(data["opcodes"].items(),
+                                  key=lambda item: -item[1])[:top]:
+            print(f"  {name:8} {count}", file=file)
+
+        print("addresses:", file=file)
+        for address, count in sorted(data["addresses"].items(),
+                                     key=lambda item: -item[1])[:top]:
+            print(f"  {address:8} {count}", file=file)
+
+        if data["subroutines"]:
+            print("subroutines:", file=file)
+            for name, info in sorted(data["subroutines"].items(),
+                                     key=lambda item: -item[1]["cycles"])[:top]:
+                print(f"  {name:16} {info['calls']:8} calls {info['cycles']:10} cycles",
+                      file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="profiler.py", description="Run an LS-8 program with profiling.")
+    parser.add_argument("program")
+    parser.add_argument("--json", help="write the counts as JSON here")
+    parser.add_argument("--folded", help="write folded call stacks here")
+    parser.add_argument("--max-cycles", type=int, default=None)
+    args = parser.parse_args(argv[1:])
+
+    cpu = CPU()
+    cpu.output = BufferedSink(sys.stdout)
+
+    try:
+        cpu.load(args.program)
+    except LoadError as e:
+        print(e)
+        return e.exit_code
+
+    profiler = Profiler(cpu)
+    try:
+        profiler.run(args.max_cycles)
+    finally:
+        # Whatever was counted is still worth reporting after an error
+        profiler.report()
+        if args.json:
+            profiler.write_json(args.json)
+        if args.folded:
+            profiler.write_folded(args.folded)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
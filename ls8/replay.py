@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""Record external events with their cycle numbers and replay them exactly."""
+
+import argparse
+import sys
+
+from cpu import *
+from compiler import BlockCompiler
+from sinks import BufferedSink, ListSink
+
+"""
+    Event logs
+    ----------
+One event per line: the cycle it arrived at, its kind and its value.
+
+    1520 key 97
+    4096 interrupt 0
+    9000 end 0
+
+"key" is a keystroke (the value is its code) and "interrupt" raises the
+interrupt with that number. "end" is the cycle the recorded run stopped
+at (its value is unused), so the replay of a program that never halts
+stops there too. Blank lines and lines starting with # are skipped.
+Events are kept in cycle order.
+"""
+EVENT_KINDS = ("key", "interrupt", "end")
+
+
+def apply_event(cpu, kind, value):
+    """Deliver one event to a CPU, the way the device that made it would."""
+    if kind == "key":
+        cpu.key_press(value)
+    elif kind == "interrupt":
+        cpu.interrupt(value)
+    else:
+        raise ValueError(f"Unknown event kind: {kind}")
+
+
+def record(cpu):
+    """Start logging the CPU's external events. Returns the (live) log."""
+    cpu.event_log = []
+    return cpu.event_log
+
+
+def save_events(events, path, end=None):
+    """Write a log, ending at cycle end if the run's last cycle is known."""
+    with open(path, "w") as f:
+        for cycle, kind, value in events:
+            f.write(f"{cycle} {kind} {value}\n")
+        if end is not None:
+            f.write(f"{end} end 0\n")
+
+
+def load_events(path):
+    events = []
+
+    try:
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                temp = line.split()
+
+                # Bypass blank lines and comments
+                if len(temp) == 0 or temp[0][0] == '#':
+                    continue
+
+                try:
+                    cycle, kind, value = temp
+                    events.append((int(cycle), kind, int(value)))
+                except ValueError:
+                    raise LoadError(f"Invalid event on line {number}: {line.strip()}", 1)
+
+                if kind not in EVENT_KINDS:
+                    raise LoadError(f"Unknown event kind on line {number}: {kind}", 1)
+
+    except FileNotFoundError:
+        raise LoadError(f"Couldn't open {path}", 2)
+
+    # The log is written in order, but be forgiving of hand-written ones
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+class Replayer:
+    """
+    Runs a CPU and delivers logged events at the cycles they were recorded
+    at. Nothing waits on a clock: the CPU runs flat out between events, so
+    a program that waited a second for a timer tick replays instantly.
+
+    A log with an "end" event stops the run at that cycle, where the
+    recording stopped. The interpreter stops on exactly the cycle asked
+    for, so replays on it are exact. Compiled blocks only stop between
+    blocks, so with engine="block" an event lands at the first block
+    boundary at or after its cycle.
+    """
+
+    def __init__(self, cpu, events, engine=None):
+        self.cpu = cpu
+        # The cycle the recording stopped at, if the log says
+        self.end = None
+        for cycle, kind, value in events:
+            if kind == "end":
+                self.end = cycle
+        self.events = [event for event in events if event[1] != "end"]
+        # Index of the next event to deliver
+        self.position = 0
+        self.engine = BlockCompiler(cpu).execute if engine == "block" else None
+
+    def run(self, max_cycles=None, capture=False):
+        """Run until the program stops, delivering events on the way."""
+        cpu = self.cpu
+        events = self.events
+
+        if capture:
+            output = cpu.output
+            cpu.output = ListSink()
+
+        start = cpu.cycles
+        stop = None if max_cycles is None else start + max_cycles
+        if self.end is not None and (stop is None or self.end < stop):
+            stop = self.end
+        text = None
+
+        try:
+            while True:
+                # Deliver everything that is due
+                while self.position < len(events) and \
+                        events[self.position][0] <= cpu.cycles:
+                    cycle, kind, value = events[self.position]
+                    apply_event(cpu, kind, value)
+                    self.position += 1
+
+                # Run up to the next event, or the end of the budget
+                target = stop
+                if self.position < len(events):
+                    target = events[self.position][0]
+                    if stop is not None and stop < target:
+                        target = stop
+
+                limit = None if target is None else target - cpu.cycles
+                result = cpu.run(limit, engine=self.engine)
+
+                if result.reason != CYCLE_LIMIT:
+                    break
+                if stop is not None and cpu.cycles >= stop:
+                    break
+        finally:
+            if capture:
+                text = cpu.output.getvalue()
+                cpu.output = output
+
+        return RunResult(cpu.halt_reason, cpu.cycles - start, text)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="replay.py", description="Replay logged events into an LS-8 program.")
+    parser.add_argument("program")
+    parser.add_argument("events", help="event log to replay")
+    parser.add_argument("--engine", choices=("interp", "block"), default="interp")
+    parser.add_argument("--max-cycles", type=int, default=None)
+    args = parser.parse_args(argv[1:])
+
+    cpu = CPU()
+    cpu.output = BufferedSink(sys.stdout)
+
+    try:
+        cpu.load(args.program)
+        events = load_events(args.events)
+    except LoadError as e:
+        print(e)
+        return e.exit_code
+
+    result = Replayer(cpu, events, args.engine).run(args.max_cycles)
+    print(f"{result.reason} after {result.cycles} cycles", file=sys.stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""asyncio front end that hosts many CPUs in one event loop."""
+
+import asyncio
+import sys
+
+from cpu import *
+from compiler import BlockCompiler
+
+# Instructions a machine runs before yielding to the others
+SLICE_CYCLES = 2048
+
+
+class QueueWriter:
+    """Text stream that puts everything written to it on an asyncio queue."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, text):
+        self.queue.put_nowait(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class Machine:
+    """
+    One CPU hosted by the scheduler. Its output arrives on an async stream
+    and keystrokes can be fed to it at any time.
+    """
+
+    def __init__(self, cpu, compiled=False):
+        self.cpu = cpu
+        # Run compiled blocks instead of interpreting, if asked
+        self.engine = BlockCompiler(cpu).execute if compiled else None
+        # Text the program prints; None marks the end of the stream
+        self.output = asyncio.Queue()
+        cpu.output = QueueWriter(self.output)
+        # Keystrokes waiting to be delivered to the program
+        self.input = asyncio.Queue()
+        # Set when a keystroke arrives, to wake a parked machine
+        self.wakeup = asyncio.Event()
+        # Set to the final RunResult (or exception) when the program stops
+        self.result = asyncio.get_running_loop().create_future()
+        # Total instructions executed across all slices
+        self.cycles = 0
+
+    def feed(self, key):
+        """Queue a keystroke (a character or its code) for the program."""
+        if isinstance(key, str):
+            key = ord(key)
+        self.input.put_nowait(key & 0xFF)
+        self.wakeup.set()
+
+    def input_waiting(self):
+        """
+        True when there is a keystroke the program can be handed now: the
+        keyboard only holds one key, so the last one's interrupt must have
+        been taken first.
+        """
+        return not self.input.empty() and \
+            not self.cpu.reg[IS] & (1 << KEYBOARD_INTERRUPT)
+
+    def deliver_input(self):
+        """
+        Hand the program the next queued keystroke, the way the keyboard
+        does: store it at 0xF4 and raise the keyboard interrupt.
+        """
+        if self.input_waiting():
+            self.cpu.key_press(self.input.get_nowait())
+
+    def spinning(self):
+        """
+        True when the program is idling in a JMP to itself with no
+        interrupt it can take, so nothing changes until a key arrives.
+        Never true with polled devices attached (a Timer, say): run()
+        is the only thing that polls them.
+        """
+        cpu = self.cpu
+
+        if cpu.devices:
+            return False
+
+        if cpu.reg[IM] & cpu.reg[IS] and cpu.interrupts_enabled:
+            return False
+
+        if cpu.ram[cpu.pc] != JMP:
+            return False
+
+        reg_num = cpu.ram[(cpu.pc + 1) & 0xFF]
+        return reg_num < 8 and cpu.reg[reg_num] == cpu.pc
+
+    async def stream(self):
+        """Yield the program's output as it is printed, until it stops."""
+        while True:
+            text = await self.output.get()
+            if text is None:
+                return
+            yield text
+
+    async def wait(self):
+        """Wait for the program to stop and return its final RunResult."""
+        return await self.result
+
+
+class Scheduler:
+    """Runs every hosted machine in bounded slices, round robin."""
+
+    def __init__(self, slice_cycles=SLICE_CYCLES):
+        self.slice_cycles = slice_cycles
+        self.machines = []
+        self.tasks = []
+
+    def add(self, cpu, compiled=False):
+        """Start hosting a CPU whose program is already loaded."""
+        machine = Machine(cpu, compiled)
+        self.machines.append(machine)
+        self.tasks.append(asyncio.create_task(self.drive(machine)))
+        return machine
+
+    async def drive(self, machine):
+        """Run one machine slice by slice, yielding to the loop in between."""
+        cpu = machine.cpu
+
+        try:
+            while True:
+                # Keystrokes only arrive between slices, never mid-slice
+                machine.deliver_input()
+
+                result = cpu.run(self.slice_cycles, engine=machine.engine)
+                machine.cycles += result.cycles
+
+                if result.reason != CYCLE_LIMIT:
+                    break
+
+                # An idle machine gets no slices until there is input for it
+                if machine.spinning() and not machine.input_waiting():
+                    machine.wakeup.clear()
+                    await machine.wakeup.wait()
+                    continue
+
+                # Let the other machines (and any I/O) have a turn
+                await asyncio.sleep(0)
+
+            machine.result.set_result(
+                RunResult(result.reason, machine.cycles))
+
+        except Exception as e:
+            machine.result.set_exception(e)
+
+        finally:
+            # End of the output stream
+            machine.output.put_nowait(None)
+
+    async def join(self):
+        """Wait for every hosted machine to stop."""
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+async def main(argv):
+    """Run every program on the command line at once, prefixing its output."""
+
+    scheduler = Scheduler()
+
+    async def show(name, machine):
+        # Output arrives in pieces, so only print whole lines
+        pending = ""
+        async for text in machine.stream():
+            pending += text
+            *lines, pending = pending.split("\n")
+            for line in lines:
+                print(f"{name}: {line}")
+        if pending:
+            print(f"{name}: {pending}")
+
+    printers = []
+
+    for filename in argv[1:]:
+        cpu = CPU()
+
+        try:
+            cpu.load(filename)
+        except LoadError as e:
+            print(e, file=sys.stderr)
+            return e.exit_code
+
+        machine = scheduler.add(cpu)
+        printers.append(show(filename, machine))
+
+    await asyncio.gather(*printers)
+    await scheduler.join()
+
+    # Report programs that stopped on an error
+    status = 0
+    for filename, machine in zip(argv[1:], scheduler.machines):
+        if machine.result.exception() is not None:
+            print(f"{filename}: {machine.result.exception()}", file=sys.stderr)
+            status = 1
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(sys.argv)))
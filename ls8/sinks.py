@@ -0,0 +1,88 @@
+"""Output sinks: where PRN and PRA send their text."""
+
+import sys
+
+"""
+A sink is anything with write(text) and flush(). CPU.run() flushes its
+sink every time it returns, so buffered text is never held past a halt.
+"""
+
+# Writes a BufferedSink holds before passing them on
+BUFFER_WRITES = 512
+
+
+class BufferedSink:
+    """Collects writes and passes them to a text stream in batches."""
+
+    def __init__(self, stream=None, limit=BUFFER_WRITES):
+        # The stream to write to, sys.stdout by default
+        self.stream = sys.stdout if stream is None else stream
+        self.limit = limit
+        self.pieces = []
+
+    def write(self, text):
+        self.pieces.append(text)
+        # Pass the batch on once it's full
+        if len(self.pieces) >= self.limit:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.pieces:
+            self.stream.write("".join(self.pieces))
+            self.pieces.clear()
+        self.stream.flush()
+
+
+class ListSink:
+    """Keeps everything written in memory, as a list of strings."""
+
+    def __init__(self):
+        self.pieces = []
+
+    def write(self, text):
+        self.pieces.append(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        """Return everything written so far as one string."""
+        return "".join(self.pieces)
+
+
+class BytesSink:
+    """
+    Keeps everything written in memory as encoded bytes, and optionally
+    passes them on to a binary stream when flushed.
+    """
+
+    def __init__(self, stream=None, encoding="utf-8"):
+        self.stream = stream
+        self.encoding = encoding
+        self.buffer = bytearray()
+
+    def write(self, text):
+        self.buffer += text.encode(self.encoding)
+        return len(text)
+
+    def flush(self):
+        if self.stream is not None:
+            self.stream.write(self.buffer)
+            self.stream.flush()
+            self.buffer.clear()
+
+    def getvalue(self):
+        """Return the bytes written since the last flush."""
+        return bytes(self.buffer)
+
+
+class NullSink:
+    """Throws everything away, for benchmarking without I/O."""
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""Binary execution tracing into a preallocated ring buffer."""
+
+import argparse
+import gzip
+import struct
+import sys
+
+from cpu import *
+from sinks import BufferedSink
+
+"""
+    Trace records
+    -------------
+One fixed-size record per instruction: cycle number (8 bytes), PC, IR,
+operand A, operand B, FL after the instruction, then R0-R7 after the
+instruction. Register and flag deltas are worked out when records are
+read back, by comparing each record with the one before it.
+
+Streamed trace files are gzip-compressed: the magic number "LS8T", then
+records back to back.
+"""
+RECORD = struct.Struct("<QBBBBB8s")
+TRACE_MAGIC = b"LS8T"
+
+# Records kept in memory by default
+RING_SIZE = 4096
+
+
+class TraceRecorder:
+    """
+    Tracing execution engine. Keeps the last size records in a ring buffer
+    that is allocated once, so tracing costs a struct pack per instruction
+    rather than a formatted print. The buffer is dumped when the program
+    crashes (and on halt, if asked), and can also be streamed to a
+    compressed file as it fills.
+    """
+
+    def __init__(self, cpu, size=RING_SIZE, stream=None, dump_on_halt=False,
+                 dump_file=None):
+        self.cpu = cpu
+        self.size = size
+        self.buffer = bytearray(RECORD.size * size)
+        # Byte offset of the next record, and records written so far
+        self.offset = 0
+        self.count = 0
+        self.dump_on_halt = dump_on_halt
+        # Where dumps go, stderr by default
+        self.dump_file = dump_file
+
+        # Full buffers are written here as the ring wraps
+        self.stream = None
+        if stream is not None:
+            self.stream = gzip.open(stream, "wb")
+            self.stream.write(TRACE_MAGIC)
+
+    def run(self, max_cycles=None, capture=False, timeout=None):
+        """Run the CPU's program with tracing. Same arguments as CPU.run()."""
+        return self.cpu.run(max_cycles, capture, self.execute, timeout)
+
+    def execute(self, limit=None):
+        """The interpreter loop from CPU.execute(), recording every instruction."""
+        cpu = self.cpu
+        # Start the program
+        cpu.running = True
+        cpu.halt_reason = None
+
+        # Local aliases for the loop
+        ram = cpu.ram
+        reg = cpu.reg
+        decoded = cpu.decoded
+        decode = cpu.decode
+        buffer = self.buffer
+        end = len(buffer)
+        pack_into = RECORD.pack_into
+        record_size = RECORD.size
+        offset = self.offset
+        cycles = cpu.cycles
+        pc = cpu.pc
+        if limit is None:
+            limit = -1
+
+        try:
+            while cpu.running:
+                if cycles == limit:
+                    cpu.running = False
+                    cpu.halt_reason = CYCLE_LIMIT
+                    break
+
+                if reg[5] & reg[6] and cpu.interrupts_enabled:
+                    cpu.serve_interrupt()
+
+                pc = cpu.pc
+                entry = decoded[pc]
+                if entry is None:
+                    entry = decode(pc)
+
+                handler, operand_a, operand_b, cpu.pc = entry
+                # Read IR first, the instruction may overwrite itself
+                ir = ram[pc]
+                handler(operand_a, operand_b)
+
+                pack_into(buffer, offset, cycles, pc, ir,
+                          operand_a, operand_b, cpu.FL, bytes(reg))
+                cycles += 1
+
+                offset += record_size
+                if offset == end:
+                    # The ring is full: stream it out before overwriting
+                    if self.stream is not None:
+                        self.stream.write(buffer)
+                    offset = 0
+
+        except Exception:
+            # Post-mortem: show what led up to the crash
+            self.save(offset, cycles)
+            self.dump()
+            print(f"-- crashed at {pc:02X} --", file=self.dump_file or sys.stderr)
+            raise
+
+        self.save(offset, cycles)
+
+        if self.dump_on_halt and cpu.halt_reason != CYCLE_LIMIT:
+            self.dump()
+
+    def save(self, offset, cycles):
+        """Store the loop's locals back on the recorder and the CPU."""
+        self.count += (cycles - self.cpu.cycles)
+        self.offset = offset
+        self.cpu.cycles = cycles
+
+    def close(self):
+        """Write whatever the stream hasn't seen yet and close it."""
+        if self.stream is not None:
+            self.stream.write(self.buffer[:self.offset])
+            self.stream.close()
+            self.stream = None
+
+    """
+    ---------- Reading records ----------
+    """
+    def records(self):
+        """The buffered records, oldest first, as tuples."""
+        if self.count < self.size:
+            data = self.buffer[:self.offset]
+        else:
+            # The oldest record is the one about to be overwritten
+            data = self.buffer[self.offset:] + self.buffer[:self.offset]
+        return list(RECORD.iter_unpack(data))
+
+    def dump(self, file=None):
+        """Print the buffered records, oldest first."""
+        if file is None:
+            file = self.dump_file if self.dump_file is not None else sys.stderr
+
+        records = self.records()
+        print(f"-- last {len(records)} of {self.count} instructions --", file=file)
+        for line in format_records(records):
+            print(line, file=file)
+
+
+def format_records(records):
+    """
+    Turn records into text lines, showing only the registers and flags
+    each instruction changed (everything, for the first record).
+    """
+    previous_regs = None
+    previous_fl = None
+
+    for cycles, pc, ir, operand_a, operand_b, fl, regs in records:
+        name = OPCODE_NAMES.get(ir, f"{ir:08b}")
+        changes = []
+
+        for n in range(8):
+            if previous_regs is None or regs[n] != previous_regs[n]:
+                changes.append(f"R{n}={regs[n]:02X}")
+        if fl != previous_fl:
+            changes.append(f"FL={fl:03b}")
+
+        yield (f"{cycles:10} {pc:02X} | {ir:02X} {operand_a:02X} {operand_b:02X} "
+               f"{name:5}| {' '.join(changes)}")
+
+        previous_regs = regs
+        previous_fl = fl
+
+
+def read_trace(path):
+    """Yield the records from a streamed trace file."""
+    with gzip.open(path, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"Not an LS-8 trace: {path}")
+
+        while True:
+            data = f.read(RECORD.size * RING_SIZE)
+            if not data:
+                return
+            yield from RECORD.iter_unpack(data)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="tracer.py", description="Run an LS-8 program with tracing.")
+    parser.add_argument("program", help="program to run, or a trace file with --read")
+    parser.add_argument("--size", type=int, default=RING_SIZE,
+                        help="records kept in memory")
+    parser.add_argument("--stream", help="also write every record to this gzip file")
+    parser.add_argument("--dump", action="store_true",
+                        help="print the buffered records when the program halts")
+    parser.add_argument("--read", action="store_true",
+                        help="print a trace file written by --stream")
+    parser.add_argument("--max-cycles", type=int, default=None)
+    args = parser.parse_args(argv[1:])
+
+    if args.read:
+        for line in format_records(read_trace(args.program)):
+            print(line)
+        return 0
+
+    cpu = CPU()
+    cpu.output = BufferedSink(sys.stdout)
+
+    try:
+        cpu.load(args.program)
+    except LoadError as e:
+        print(e)
+        return e.exit_code
+
+    tracer = TraceRecorder(cpu, args.size, args.stream, args.dump)
+    try:
+        tracer.run(args.max_cycles)
+    finally:
+        tracer.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+"""Lockstep engine: runs many LS-8 machines at once as NumPy arrays."""
+
+import argparse
+import sys
+import time
+
+from cpu import *
+
+try:
+    import numpy as np
+except ImportError:
+    # Only this engine needs NumPy
+    np = None
+
+# Halt reason for a machine that hit an unknown opcode or a register
+# operand past R7. CPU.run raises instead, but one bad machine shouldn't
+# stop all the others.
+INVALID = "invalid_instruction"
+
+# Flag bits each conditional jump tests (JNE jumps when its bit is clear)
+JUMP_FLAGS = {
+    JEQ: 0b001,
+    JNE: 0b001,
+    JGT: 0b010,
+    JLT: 0b100,
+    JLE: 0b101,
+    JGE: 0b011,
+}
+
+
+class Fleet:
+    """
+    N machines stepped together, for running one program over many
+    different starting states. Machine i is ram[i], reg[i], pc[i] and
+    fl[i]; set these up (or use from_cpu()) and call run().
+
+    Every step fetches the opcode of each running machine, groups the
+    machines by opcode and executes each group with array operations, so
+    Python dispatch costs once per opcode per step instead of once per
+    machine. The ALU semantics are the ones in cpu.ALU_OPS, applied to
+    whole columns of registers.
+    """
+
+    def __init__(self, n):
+        if np is None:
+            raise LS8Error("The lockstep engine needs NumPy")
+
+        self.n = n
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.reg = np.zeros((n, 8), dtype=np.uint8)
+        self.reg[:, 7] = 0xF4
+        self.pc = np.zeros(n, dtype=np.int64)
+        self.fl = np.zeros(n, dtype=np.int64)
+        self.interrupts_enabled = np.ones(n, dtype=bool)
+        self.running = np.zeros(n, dtype=bool)
+        self.halt_reason = np.full(n, None, dtype=object)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        # What each machine printed, as a list of strings
+        self.output = [[] for _ in range(n)]
+
+    @classmethod
+    def from_cpu(cls, cpu, n):
+        """N copies of a CPU's state, e.g. after loading a program."""
+        fleet = cls(n)
+        fleet.ram[:] = np.frombuffer(bytes(cpu.ram), dtype=np.uint8)
+        fleet.reg[:] = np.frombuffer(bytes(cpu.reg), dtype=np.uint8)
+        fleet.pc[:] = cpu.pc
+        fleet.fl[:] = cpu.FL
+        fleet.interrupts_enabled[:] = cpu.interrupts_enabled
+        return fleet
+
+    def machine(self, i):
+        """A CPU holding machine i's current state."""
+        cpu = CPU()
+        cpu.ram[:] = self.ram[i].tobytes()
+        cpu.reg[:] = self.reg[i].tobytes()
+        cpu.pc = int(self.pc[i])
+        cpu.FL = int(self.fl[i])
+        cpu.interrupts_enabled = bool(self.interrupts_enabled[i])
+        cpu.cycles = int(self.cycles[i])
+        return cpu
+
+    """
+    ---------- Run the machines ----------
+    """
+    def run(self, max_cycles=None):
+        """
+        Step every machine until it halts, or until it has executed
+        max_cycles more instructions. Machines stopped by the cycle limit
+        can be resumed by calling run() again. Returns the results.
+        """
+        # Everything that hasn't stopped for good starts (again)
+        for i, reason in enumerate(self.halt_reason):
+            if reason is None or reason == CYCLE_LIMIT:
+                self.running[i] = True
+                self.halt_reason[i] = None
+
+        steps = 0
+        while True:
+            rows = np.flatnonzero(self.running)
+            if len(rows) == 0:
+                break
+
+            # Stop (resumably) once the cycle budget is spent
+            if steps == max_cycles:
+                self.halt(rows, CYCLE_LIMIT)
+                break
+
+            self.step(rows)
+            steps += 1
+
+        return self.results()
+
+    def results(self):
+        """One RunResult per machine, with its cycles and output so far."""
+        return [
+            RunResult(self.halt_reason[i], int(self.cycles[i]), "".join(self.output[i]))
+            for i in range(self.n)
+        ]
+
+    def step(self, rows):
+        """Execute one instruction on each of the given (running) machines."""
+        ram = self.ram
+        reg = self.reg
+
+        # One masked test for interrupts, like CPU.execute()
+        pending = (reg[rows, 5] & reg[rows, 6]) != 0
+        pending &= self.interrupts_enabled[rows]
+        if pending.any():
+            self.serve_interrupts(rows[pending])
+
+        ir = ram[rows, self.pc[rows]]
+        self.cycles[rows] += 1
+
+        for op in np.unique(ir):
+            self.execute(int(op), rows[ir == op])
+
+    def halt(self, rows, reason):
+        self.running[rows] = False
+        self.halt_reason[rows] = reason
+
+    def invalid(self, rows):
+        # The instruction never ran, so it doesn't count
+        self.cycles[rows] -= 1
+        self.halt(rows, INVALID)
+
+    """
+    ---------- Instructions ----------
+    """
+    def execute(self, op, rows):
+        """Execute the instruction op on every machine in rows."""
+        ram = self.ram
+        reg = self.reg
+
+        if op not in OPCODE_NAMES:
+            self.invalid(rows)
+            return
+
+        # Decode the same way CPU.decode() does
+        pc = self.pc[rows]
+        count = op >> 6
+        a = ram[rows, (pc + 1) & 0xFF].astype(np.int64)
+        b = ram[rows, (pc + 2) & 0xFF].astype(np.int64)
+        next_pc = (pc + count + 1) & 0xFF
+
+        # Register operands past R7 (LDI's second operand is an immediate)
+        if count >= 1:
+            bad = a > 7
+            if count == 2 and op != LDI:
+                bad |= b > 7
+            if bad.any():
+                self.invalid(rows[bad])
+                good = ~bad
+                rows, a, b, next_pc = rows[good], a[good], b[good], next_pc[good]
+
+        self.pc[rows] = next_pc
+
+        if op & 0b00100000:
+            self.alu(op, rows, a, b)
+
+        elif op == NOP:
+            pass
+
+        elif op == HLT:
+            self.halt(rows, HALTED)
+
+        elif op == LDI:
+            reg[rows, a] = b
+
+        elif op == LD:
+            reg[rows, a] = ram[rows, reg[rows, b]]
+
+        elif op == ST:
+            ram[rows, reg[rows, a]] = reg[rows, b]
+
+        elif op == PRN or op == PRA:
+            # Output is per machine, and rare, so a plain loop will do
+            for i, value in zip(rows, reg[rows, a]):
+                self.output[i].append(f"{value}\n" if op == PRN else chr(value))
+
+        elif op == PUSH:
+            # Same order as CPU.PUSH: SP moves before the register is
+            # read, which matters for PUSH R7
+            sp = (reg[rows, 7].astype(np.int64) - 1) & 0xFF
+            reg[rows, 7] = sp
+            ram[rows, sp] = reg[rows, a]
+
+        elif op == POP:
+            # Same order as CPU.POP, which matters for POP R7
+            reg[rows, a] = ram[rows, reg[rows, 7]]
+            reg[rows, 7] = (reg[rows, 7].astype(np.int64) + 1) & 0xFF
+
+        elif op == CALL:
+            self.push(rows, next_pc)
+            self.pc[rows] = reg[rows, a]
+
+        elif op == RET:
+            self.pc[rows] = self.pop(rows)
+
+        elif op == JMP:
+            self.pc[rows] = reg[rows, a]
+
+        elif op in JUMP_FLAGS:
+            take = (self.fl[rows] & JUMP_FLAGS[op]) != 0
+            if op == JNE:
+                take = ~take
+            self.pc[rows[take]] = reg[rows[take], a[take]]
+
+        elif op == INT:
+            reg[rows, IS] |= (1 << (reg[rows, a] & 7)).astype(np.uint8)
+
+        elif op == IRET:
+            for n in range(6, -1, -1):
+                reg[rows, n] = self.pop(rows)
+            self.fl[rows] = self.pop(rows)
+            self.pc[rows] = self.pop(rows)
+            self.interrupts_enabled[rows] = True
+
+    def alu(self, op, rows, a, b):
+        """ALU operations, from the CPU's ALU table."""
+        reg = self.reg
+        name, function, expression = ALU_OPS[op & 0x0F]
+
+        value_a = reg[rows, a].astype(np.int64)
+        # One-operand instructions don't have a registerB
+        value_b = reg[rows, b].astype(np.int64) if op >> 6 == 2 else 0
+
+        if name == "CMP":
+            self.fl[rows] = function(value_a, value_b)
+            return
+
+        if name in ("DIV", "MOD"):
+            # Same as the CPU: a zero registerB halts the machine
+            zero = value_b == 0
+            if zero.any():
+                self.halt(rows[zero], DIVIDE_BY_ZERO)
+                rows, a, value_a, value_b = \
+                    rows[~zero], a[~zero], value_a[~zero], value_b[~zero]
+
+        if name in ("SHL", "SHR"):
+            # Python shifts by any amount; NumPy's are undefined past 63.
+            # Past 8 the low byte is 0 either way
+            value_b = np.minimum(value_b, 8)
+
+        reg[rows, a] = function(value_a, value_b) & 0xFF
+
+    """
+    ---------- Stack and interrupts ----------
+    """
+    def push(self, rows, values):
+        sp = (self.reg[rows, 7].astype(np.int64) - 1) & 0xFF
+        self.reg[rows, 7] = sp
+        self.ram[rows, sp] = values
+
+    def pop(self, rows):
+        sp = self.reg[rows, 7].astype(np.int64)
+        values = self.ram[rows, sp].astype(np.int64)
+        self.reg[rows, 7] = (sp + 1) & 0xFF
+        return values
+
+    def serve_interrupts(self, rows):
+        """CPU.serve_interrupt() for every machine in rows at once."""
+        reg = self.reg
+
+        masked = (reg[rows, IM] & reg[rows, IS]).astype(np.int64)
+        # Lowest pending interrupt of each machine
+        bit = masked & -masked
+
+        self.interrupts_enabled[rows] = False
+        reg[rows, IS] &= (~bit & 0xFF).astype(np.uint8)
+
+        self.push(rows, self.pc[rows])
+        self.push(rows, self.fl[rows])
+        for n in range(7):
+            self.push(rows, reg[rows, n])
+
+        number = np.log2(bit).astype(np.int64)
+        self.pc[rows] = self.ram[rows, VECTOR_TABLE + number]
+
+
+def verify(fleet, max_cycles=None):
+    """
+    Run the fleet, and every machine in it on CPU.run as well. Returns the
+    indexes of the machines whose results or final state differ.
+    """
+    cpus = [fleet.machine(i) for i in range(fleet.n)]
+    results = fleet.run(max_cycles)
+    mismatches = []
+
+    for i, cpu in enumerate(cpus):
+        try:
+            result = cpu.run(max_cycles, capture=True)
+        except LS8Error:
+            # The fleet reports these as INVALID rather than raising
+            if results[i].reason != INVALID:
+                mismatches.append(i)
+            continue
+
+        if (result.reason != results[i].reason
+                or result.output != results[i].output
+                or bytes(cpu.ram) != fleet.ram[i].tobytes()
+                or bytes(cpu.reg) != fleet.reg[i].tobytes()
+                or cpu.pc != fleet.pc[i]
+                or cpu.FL != fleet.fl[i]):
+            mismatches.append(i)
+
+    return mismatches
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="vector.py",
+        description="Run one LS-8 program on many machines with random registers.")
+    parser.add_argument("program")
+    parser.add_argument("-n", "--machines", type=int, default=1000)
+    parser.add_argument("--max-cycles", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--check", action="store_true",
+                        help="also run every machine on CPU.run and compare")
+    args = parser.parse_args(argv[1:])
+
+    cpu = CPU()
+    try:
+        cpu.load(args.program)
+    except LoadError as e:
+        print(e)
+        return e.exit_code
+
+    try:
+        fleet = Fleet.from_cpu(cpu, args.machines)
+    except LS8Error as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    # Random R0-R4 for each machine (R5-R7 are reserved)
+    rng = np.random.default_rng(args.seed)
+    fleet.reg[:, :5] = rng.integers(0, 256, size=(args.machines, 5), dtype=np.uint8)
+
+    start = time.perf_counter()
+    if args.check:
+        mismatches = verify(fleet, args.max_cycles)
+    else:
+        fleet.run(args.max_cycles)
+    seconds = time.perf_counter() - start
+
+    reasons = {}
+    for reason in fleet.halt_reason:
+        reasons[reason] = reasons.get(reason, 0) + 1
+    for reason, count in sorted(reasons.items()):
+        print(f"{reason:20} {count}")
+
+    instructions = int(fleet.cycles.sum())
+    print(f"{instructions} instructions in {seconds:.3f}s")
+
+    if args.check:
+        print(f"{len(mismatches)} machines differ from CPU.run")
+        return 1 if mismatches else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))